@@ -1,29 +1,108 @@
-from flask import Flask, render_template, request, redirect, session, url_for, jsonify, flash
-from models import db, User, Attendance
+from flask import Blueprint, Flask, Response, abort, current_app, render_template, request, redirect, session, stream_with_context, url_for, jsonify, flash
+from models import db, User, Attendance, FaceTemplate, GalleryState, ensure_indexes
+from attendance_log import attendance_log
+from attendance_export import csv_stream, json_stream, gzip_stream
 from config import Config
 from camera import camera
+from face_index import create_index
+from face_utils import DetectionSettings, IngestSettings, load_models
+from metrics import metrics, profiler
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
+import os
 import io
+import click
+import threading
+import uuid
 
-app = Flask(__name__)
-app.config.from_object(Config)
+main = Blueprint('main', __name__, cli_group=None)
 
-# Initialize database
-db.init_app(app)
 
-# Create database tables if they don't exist
-with app.app_context():
-    db.create_all()
-    # Load users for face recognition
-    camera.update_users(User.query.all())
+def create_app(config_class=Config):
+    """Create the Flask app, load the face gallery and start the background services.
 
-@app.route('/')
+    Nothing runs at import time, so recognition workers (which re-import the
+    main module) and CLI tools only pay for what they use. The dlib models
+    are loaded on first use.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    # Initialize database
+    db.init_app(app)
+
+    # Stage timers, counters and sampled profiles of the recognition path (off by default)
+    metrics.configure(app.config['METRICS_ENABLED'], window=app.config['METRICS_WINDOW'])
+    profiler.configure(app.config['PROFILE_SAMPLE_RATE'],
+                       app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles'),
+                       app.config['PROFILE_MAX_FILES'])
+
+    # Create database tables if they don't exist
+    with app.app_context():
+        db.create_all()
+        ensure_indexes()
+        # Detection tuning shared by registration and attendance
+        camera.configure_detection(DetectionSettings(
+            max_pixels=app.config['FACE_DETECTION_MAX_PIXELS'],
+            upsample=app.config['FACE_DETECTION_UPSAMPLE'],
+            model=app.config['FACE_DETECTION_MODEL'],
+            landmarks=app.config['FACE_LANDMARK_MODEL'],
+            rgb_input=app.config['FACE_DETECTION_RGB_INPUT']
+        ))
+        # Size limits and reduced-resolution decoding of uploaded images
+        camera.configure_ingest(IngestSettings(
+            max_bytes=app.config['MAX_IMAGE_BYTES'],
+            max_pixels=app.config['MAX_IMAGE_PIXELS'],
+            reduced_decode=app.config['FACE_REDUCED_DECODE'],
+            roi_margin=app.config['FACE_ROI_MARGIN']
+        ))
+        # Reuse identities across a kiosk's frames to skip re-encoding
+        camera.configure_tracking(app.config['FACE_TRACK_TTL'],
+                                  iou_threshold=app.config['FACE_TRACK_IOU'],
+                                  max_hash_distance=app.config['FACE_TRACK_HASH_DISTANCE'])
+        # Learn extra templates per user from confident recognitions
+        camera.configure_templates(app.config['FACE_MAX_TEMPLATES'],
+                                   learn_distance=app.config['FACE_TEMPLATE_LEARN_DISTANCE'],
+                                   min_diversity=app.config['FACE_TEMPLATE_MIN_DIVERSITY'],
+                                   interval=app.config['FACE_TEMPLATE_LEARN_INTERVAL'])
+        # Search index for the face gallery, restored from disk when available
+        os.makedirs(app.instance_path, exist_ok=True)
+        index_path = app.config['FACE_INDEX_PATH'] or os.path.join(app.instance_path, 'face_index.npz')
+        gallery_index = create_index(app.config['FACE_INDEX'],
+                                     n_lists=app.config['FACE_INDEX_LISTS'],
+                                     n_probe=app.config['FACE_INDEX_PROBES'])
+        gallery_index.load(index_path)
+        camera.set_index(gallery_index)
+        # Map the saved gallery snapshot, or bulk load face encodings when the database changed
+        snapshot_path = app.config['GALLERY_SNAPSHOT_PATH'] or os.path.join(app.instance_path, 'gallery')
+        stamp = GalleryState.stamp()
+        if not camera.load_snapshot(snapshot_path, stamp):
+            camera.load_gallery(User.gallery_rows(), FaceTemplate.gallery_rows())
+            camera.save_snapshot(snapshot_path, stamp)
+        # Keep the index on disk in step with the rows it was trained or assigned for
+        if camera.gallery.index.modified:
+            camera.gallery.save_index(index_path)
+        # Recognize on worker processes so request threads don't block on dlib
+        camera.start_workers(app.config['RECOGNITION_WORKERS'],
+                             queue_size=app.config['RECOGNITION_QUEUE_SIZE'],
+                             timeout=app.config['RECOGNITION_TIMEOUT'])
+
+    if app.config['FACE_MODELS_PRELOAD']:
+        # Load the dlib models in the background instead of on the first capture
+        threading.Thread(target=load_models, name='load-face-models', daemon=True).start()
+
+    # Cooldown checks from memory, attendance written in periodic bulk inserts
+    attendance_log.init_app(app)
+
+    app.register_blueprint(main)
+    return app
+
+@main.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@main.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         # Check if it's a face capture request
@@ -46,42 +125,67 @@ def register():
         
         if not all([name, email]) or 'face_encoding' not in session:
             flash('All fields are required and face must be captured')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
         
         # Check if email already exists
         existing_user = User.query.filter_by(email=email).first()
         if existing_user:
             flash('Email already registered')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
         
         try:
             # Create new user
             user = User(name=name, email=email, custom_data=custom_data)
-            user.set_face_encoding(np.array(session.pop('face_encoding')))
+            user.set_face_encoding(np.array(session.pop('face_encoding')), current_app.config['FACE_ENCODING_DTYPE'])
             
             db.session.add(user)
             db.session.commit()
             
-            # Update users list for face recognition
-            camera.update_users(User.query.all())
+            # Add the new face to the recognition gallery
+            camera.add_user(user)
             
             flash('Registration successful')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         except Exception as e:
             db.session.rollback()
             if 'UNIQUE constraint failed: user.email' in str(e):
                 flash('Email already registered')
             else:
                 flash(f'Error during registration: {str(e)}')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
     
-    return render_template('register.html')
+    return render_template('register.html', frame_pixels=current_app.config['FACE_DETECTION_MAX_PIXELS'])
 
-@app.route('/attendance')
+@main.route('/attendance')
 def attendance():
-    return render_template('attendance.html')
+    return render_template('attendance.html', frame_pixels=current_app.config['FACE_DETECTION_MAX_PIXELS'])
+
+def parse_roi(value):
+    """Turn an 'x,y,width,height' face region into (top, right, bottom, left), or None"""
+    if not value:
+        return None
+    try:
+        x, y, width, height = (int(float(part)) for part in value.split(','))
+    except (ValueError, OverflowError):
+        return None
+    if width <= 0 or height <= 0:
+        return None
+    return (y, x + width, y + height, x)
+
+def learn_face_template(user_id, encoding):
+    """Keep a confidently recognized face as an extra template of the user"""
+    try:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return
+        user.add_face_template(encoding, current_app.config['FACE_MAX_TEMPLATES'], current_app.config['FACE_ENCODING_DTYPE'])
+        db.session.commit()
+        camera.set_user_templates(user)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error learning face template: {e}")
 
-@app.route('/process_attendance', methods=['POST'])
+@main.route('/process_attendance', methods=['POST'])
 def process_attendance():
     """Process an image from the frontend and check attendance"""
     if 'image' not in request.files:
@@ -90,21 +194,36 @@ def process_attendance():
     image_file = request.files['image']
     image_data = image_file.read()
     
-    # Process the image
-    result = camera.process_image(image_data)
+    # Each browser session is its own kiosk for face tracking
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    
+    # Process the image, only the face region when the browser found one
+    result = camera.process_image(image_data, session['client_id'], roi=parse_roi(request.form.get('roi')))
+    
+    if result.get('too_large'):
+        return jsonify({
+            'recognized': False,
+            'message': result['error']
+        }), 413
+    
+    if result.get('busy'):
+        response = jsonify({
+            'recognized': False,
+            'busy': True,
+            'message': 'Server busy, please retry'
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 503
     
     if result['recognized']:
         user_id = result['user_id']
         
-        # Check if user already has recent attendance
-        cooldown = app.config['ATTENDANCE_COOLDOWN']
-        if not Attendance.get_recent_attendance(user_id, cooldown):
-            # Log new attendance
-            user = User.query.get(user_id)
-            attendance = Attendance(user_id=user_id)
-            db.session.add(attendance)
-            db.session.commit()
-            
+        if result.get('new_template') is not None:
+            learn_face_template(user_id, result['new_template'])
+        
+        # Log new attendance unless the user is still on cooldown
+        if attendance_log.check_in(user_id):
             return jsonify({
                 'recognized': True,
                 'user': {
@@ -132,7 +251,76 @@ def process_attendance():
         'message': 'No recognized user'
     })
 
-@app.route('/check_email')
+@main.route('/process_attendance_batch', methods=['POST'])
+def process_attendance_batch():
+    """Process several images (a burst or frames from several cameras) in one request"""
+    image_files = request.files.getlist('images')
+    if not image_files:
+        return jsonify({'success': False, 'message': 'No images provided'})
+    
+    if len(image_files) > current_app.config['MAX_BATCH_IMAGES']:
+        return jsonify({
+            'success': False,
+            'message': f"At most {current_app.config['MAX_BATCH_IMAGES']} images per batch"
+        }), 413
+    
+    # Recognize the whole batch with one gallery match
+    result = camera.process_batch([image_file.read() for image_file in image_files])
+    
+    if result.get('busy'):
+        response = jsonify({
+            'success': False,
+            'busy': True,
+            'message': 'Server busy, please retry'
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    
+    if result.get('error'):
+        return jsonify({'success': False, 'message': result['error']})
+    
+    # Cooldown check and attendance for the whole batch, written together by the attendance log
+    user_ids = []
+    for image in result['images']:
+        for face in image['faces']:
+            if face['user_id'] not in user_ids:
+                user_ids.append(face['user_id'])
+    recorded = attendance_log.check_in_many(user_ids)
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    images = []
+    announced = set()
+    for image_file, image in zip(image_files, result['images']):
+        users = []
+        for face in image['faces']:
+            user_id = face['user_id']
+            # A person seen in several images of the batch is recorded once
+            newly_recorded = user_id in recorded and user_id not in announced
+            announced.add(user_id)
+            users.append({
+                'id': user_id,
+                'name': face['name'],
+                'email': face['email'],
+                'location': face['location'],
+                'message': 'Attendance recorded successfully' if newly_recorded else 'Attendance already recorded recently',
+                'timestamp': timestamp if newly_recorded else None
+            })
+        entry = {
+            'image': image_file.filename,
+            'recognized': image['recognized'],
+            'users': users
+        }
+        if image.get('error'):
+            entry['error'] = image['error']
+        images.append(entry)
+    
+    return jsonify({
+        'success': True,
+        'recorded': len(recorded),
+        'images': images
+    })
+
+@main.route('/check_email')
 def check_email():
     email = request.args.get('email')
     if not email:
@@ -142,31 +330,118 @@ def check_email():
     return jsonify({'exists': user is not None})
 
 
-@app.route('/admin')
+def parse_date(value):
+    """Parse a YYYY-MM-DD query parameter, ignoring empty or malformed values"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+@main.route('/admin')
 def admin():
-    users = User.query.all()
-    attendances = Attendance.query.order_by(Attendance.timestamp.desc()).all()
-    return render_template('admin.html', users=users, attendances=attendances)
+    # Show attendance that is still waiting in the write-behind buffer
+    attendance_log.flush()
+    
+    page_size = current_app.config['ADMIN_PAGE_SIZE']
+    filters = {
+        'start': request.args.get('start', ''),
+        'end': request.args.get('end', ''),
+        'user_id': request.args.get('user_id', type=int)
+    }
+    start = parse_date(filters['start'])
+    end = parse_date(filters['end'])
+    if end is not None:
+        # The end date is inclusive
+        end += timedelta(days=1)
+    
+    users, users_after = User.page(request.args.get('users_after', type=int), page_size)
+    
+    before = None
+    if request.args.get('before_id', type=int) is not None:
+        try:
+            before = (datetime.fromisoformat(request.args['before_time']), request.args.get('before_id', type=int))
+        except (KeyError, ValueError):
+            before = None
+    attendances, next_before = Attendance.page(before, page_size, start, end, filters['user_id'])
+    
+    return render_template(
+        'admin.html',
+        users=users,
+        users_after=users_after,
+        attendances=attendances,
+        next_before=next_before,
+        filters=filters,
+        filter_args={key: value for key, value in filters.items() if value},
+        daily_counts=Attendance.daily_counts(start, end, filters['user_id']),
+        user_counts=Attendance.user_counts(start, end, filters['user_id'])
+    )
 
-@app.route('/admin/delete_user/<int:user_id>', methods=['POST'])
+@main.route('/admin/export/attendance.<fmt>')
+def export_attendance(fmt):
+    """Stream attendance as CSV or JSON, optionally gzipped (?gzip=1)"""
+    if fmt not in ('csv', 'json'):
+        abort(404)
+    
+    # Include attendance still waiting in the write-behind buffer
+    attendance_log.flush()
+    
+    start = parse_date(request.args.get('start'))
+    end = parse_date(request.args.get('end'))
+    if end is not None:
+        end += timedelta(days=1)
+    batches = Attendance.export_batches(start, end, request.args.get('user_id', type=int),
+                                        batch_size=current_app.config['EXPORT_BATCH_SIZE'])
+    
+    stream = csv_stream(batches) if fmt == 'csv' else json_stream(batches)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/json'
+    filename = f'attendance.{fmt}'
+    if request.args.get('gzip') == '1':
+        stream = gzip_stream(stream)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+    
+    response = Response(stream_with_context(stream), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+@main.route('/admin/stats')
+def admin_stats():
+    """Recognition statistics, including how many frames skipped face encoding"""
+    return jsonify({
+        'tracking': camera.tracker.stats(),
+        'gallery_size': len(camera.gallery)
+    })
+
+@main.route('/metrics')
+def metrics_endpoint():
+    """Recognition metrics in the Prometheus text format, for local scrapers only"""
+    if not metrics.enabled:
+        abort(404)
+    if request.remote_addr not in ('127.0.0.1', '::1') and not current_app.config['METRICS_ALLOW_REMOTE']:
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@main.route('/admin/delete_user/<int:user_id>', methods=['POST'])
 def delete_user(user_id):
     user = User.query.get_or_404(user_id)
     
-    # First delete all attendance records for this user
+    # First delete all attendance records for this user, including unwritten ones
+    attendance_log.forget(user_id)
     Attendance.query.filter_by(user_id=user_id).delete()
     
     # Then delete the user
     db.session.delete(user)
     db.session.commit()
     
-    # Update users list for face recognition
-    camera.update_users(User.query.all())
+    # Remove the face from the recognition gallery
+    camera.remove_user(user_id)
     
     flash(f'User {user.name} deleted successfully')
-    return redirect(url_for('admin'))
+    return redirect(url_for('main.admin'))
 
 
-@app.route('/admin/edit_user/<int:user_id>', methods=['GET', 'POST'])
+@main.route('/admin/edit_user/<int:user_id>', methods=['GET', 'POST'])
 def edit_user(user_id):
     user = User.query.get_or_404(user_id)
     
@@ -177,25 +452,37 @@ def edit_user(user_id):
         
         db.session.commit()
         
-        # Update users list for face recognition
-        camera.update_users(User.query.all())
+        # Refresh the name and email shown on recognition
+        camera.update_user(user)
         
         flash(f'User {user.name} updated successfully')
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
     
     return render_template('edit_user.html', user=user)
 
 
 
-@app.errorhandler(404)
+@main.cli.command('migrate-encodings')
+@click.option('--dtype', type=click.Choice(['float32', 'float16']), default=None,
+              help='Storage precision (defaults to FACE_ENCODING_DTYPE)')
+@click.option('--batch-size', default=500, show_default=True, help='Rows converted per commit')
+def migrate_encodings(dtype, batch_size):
+    """Convert pickled face encodings to the binary storage format"""
+    dtype = dtype or current_app.config['FACE_ENCODING_DTYPE']
+    converted = User.migrate_face_encodings(dtype=dtype, batch_size=batch_size)
+    camera.load_gallery(User.gallery_rows(), FaceTemplate.gallery_rows())
+    click.echo(f'Converted {converted} face encodings to {dtype}')
+
+
+@main.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def server_error(e):
     return render_template('500.html'), 500
 
-@app.after_request
+@main.after_app_request
 def add_header(response):
     """Add headers to allow camera access"""
     response.headers['Feature-Policy'] = "camera 'self'"
@@ -204,5 +491,6 @@ def add_header(response):
 
 
 if __name__ == '__main__':
+    app = create_app()
     # Run with HTTPS using the generated certificates
     app.run(host='0.0.0.0', port=5000, ssl_context=('cert.pem', 'key.pem'))
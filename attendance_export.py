@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+import zlib
+
+# Columns of an exported attendance record
+EXPORT_COLUMNS = ['attendance_id', 'timestamp', 'user_id', 'name', 'email', 'custom_data']
+
+
+def _record(row):
+    return [
+        row.id,
+        row.timestamp.isoformat() if row.timestamp else None,
+        row.user_id,
+        row.name,
+        row.email,
+        row.custom_data
+    ]
+
+
+def csv_stream(partitions):
+    """Yield CSV text one chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in partitions:
+        writer.writerows(_record(row) for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def json_stream(partitions):
+    """Yield a JSON array of records one chunk per batch of rows"""
+    yield '['
+    separator = ''
+    for rows in partitions:
+        chunk = ','.join(json.dumps(dict(zip(EXPORT_COLUMNS, _record(row)))) for row in rows)
+        if chunk:
+            yield separator + chunk
+            separator = ','
+    yield ']'
+
+
+def gzip_stream(chunks, level=6):
+    """Compress a stream of text chunks into a gzip stream on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
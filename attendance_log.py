@@ -0,0 +1,123 @@
+import atexit
+import threading
+from datetime import datetime, timedelta
+from models import db, Attendance
+from metrics import metrics
+
+
+class AttendanceLog:
+    """In-process cooldown cache with write-behind attendance inserts.
+
+    The time each user was last recorded is kept in memory, so cooldown
+    checks never touch the database. New attendance rows are buffered and
+    written with one bulk insert every ``flush_interval`` seconds (or as soon
+    as ``max_pending`` rows are waiting), and once more at shutdown.
+
+    The cache is per process: run a single recognition server process per
+    database, or accept that the cooldown is enforced per process.
+    """
+
+    def __init__(self, cooldown=300, flush_interval=2.0, max_pending=500):
+        self.cooldown = timedelta(seconds=cooldown)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_seen = {}
+        self._pending = []
+        self._wake = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """Seed the cache from the database and start the background writer"""
+        self._app = app
+        self.cooldown = timedelta(seconds=app.config['ATTENDANCE_COOLDOWN'])
+        self.flush_interval = app.config['ATTENDANCE_FLUSH_INTERVAL']
+        self.max_pending = app.config['ATTENDANCE_MAX_PENDING']
+
+        with app.app_context():
+            last_seen = Attendance.last_seen_since(datetime.utcnow() - self.cooldown)
+        with self._lock:
+            self._last_seen.update(last_seen)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def check_in(self, user_id, now=None):
+        """Record attendance unless the user is on cooldown; returns the timestamp or None"""
+        recorded = self.check_in_many([user_id], now)
+        return recorded.get(user_id)
+
+    def check_in_many(self, user_ids, now=None):
+        """Record attendance for every user not on cooldown; returns {user_id: timestamp}"""
+        now = now or datetime.utcnow()
+        cutoff = now - self.cooldown
+        recorded = {}
+        cooldown_hits = 0
+        with self._lock:
+            for user_id in user_ids:
+                last_seen = self._last_seen.get(user_id)
+                if last_seen is not None and last_seen > cutoff:
+                    cooldown_hits += 1
+                    continue
+                self._last_seen[user_id] = now
+                self._pending.append({'user_id': user_id, 'timestamp': now})
+                recorded[user_id] = now
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+        metrics.count('cooldown_hits', cooldown_hits)
+        metrics.count('attendance_recorded', len(recorded))
+        return recorded
+
+    def forget(self, user_id):
+        """Drop cached and unwritten attendance for a user being deleted"""
+        # Wait for an in-flight flush so its rows are committed before the caller deletes them
+        with self._flush_lock, self._lock:
+            self._last_seen.pop(user_id, None)
+            self._pending = [row for row in self._pending if row['user_id'] != user_id]
+
+    def flush(self):
+        """Write buffered attendance rows with one bulk insert"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            try:
+                with metrics.timer('db_flush'), self._app.app_context():
+                    db.session.execute(db.insert(Attendance), rows)
+                    db.session.commit()
+            except Exception as e:
+                metrics.count('errors')
+                print(f"Error writing attendance: {e}")
+                # Keep the rows for the next attempt
+                with self._lock:
+                    self._pending = rows + self._pending
+                return 0
+            return len(rows)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            self.prune()
+
+    def close(self):
+        """Flush whatever is still buffered (called at shutdown)"""
+        if self._app is not None:
+            self.flush()
+
+    def prune(self, now=None):
+        """Forget users whose cooldown has expired to keep the cache small"""
+        cutoff = (now or datetime.utcnow()) - self.cooldown
+        with self._lock:
+            self._last_seen = {user_id: seen for user_id, seen in self._last_seen.items() if seen > cutoff}
+
+
+# Global attendance log instance
+attendance_log = AttendanceLog()
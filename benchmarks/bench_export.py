@@ -0,0 +1,98 @@
+"""Measure throughput and peak memory of the streaming attendance export.
+
+Seeds a throwaway SQLite database with synthetic users and attendance rows,
+then streams /admin/export/attendance.<fmt> through the Flask test client.
+
+    python benchmarks/bench_export.py --rows 2000000 --format csv --gzip
+"""
+import argparse
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def seed(path, users, rows, chunk=50000):
+    """Create the schema through the models, then bulk insert with sqlite3"""
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    os.environ.setdefault('RECOGNITION_WORKERS', '0')
+    from app import create_app
+    from config import Config
+
+    # Keep the snapshot, index and profiles of the throwaway database out of instance/
+    directory = os.path.dirname(path)
+
+    class BenchConfig(Config):
+        GALLERY_SNAPSHOT_PATH = os.path.join(directory, 'gallery')
+        FACE_INDEX_PATH = os.path.join(directory, 'face_index.npz')
+        PROFILE_DIR = os.path.join(directory, 'profiles')
+
+    app = create_app(BenchConfig)
+    from models import db
+    with app.app_context():
+        db.create_all()
+
+    connection = sqlite3.connect(path)
+    blob = bytes(520)
+    connection.executemany(
+        'INSERT INTO user (id, name, email, custom_data, face_encoding, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+        ((i, f'User {i}', f'user{i}@example.com', f'Group {i % 40}', blob, '2024-01-01 00:00:00')
+         for i in range(1, users + 1))
+    )
+    start = datetime(2024, 1, 1)
+    for offset in range(0, rows, chunk):
+        connection.executemany(
+            'INSERT INTO attendance (user_id, timestamp) VALUES (?, ?)',
+            ((1 + i % users, (start + timedelta(seconds=30 * i)).strftime('%Y-%m-%d %H:%M:%S.%f'))
+             for i in range(offset, min(rows, offset + chunk)))
+        )
+        connection.commit()
+    connection.close()
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'export.db')
+        start = time.perf_counter()
+        app = seed(path, args.users, args.rows)
+        print(f'Seeded {args.rows} rows in {time.perf_counter() - start:.1f}s')
+
+        url = f'/admin/export/attendance.{args.format}' + ('?gzip=1' if args.gzip else '')
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        size = 0
+        chunks = 0
+        with app.test_client() as client:
+            response = client.get(url, buffered=False)
+            for chunk in response.response:
+                size += len(chunk)
+                chunks += 1
+            response.close()
+        elapsed = time.perf_counter() - start
+
+        print(f'Exported {args.rows} rows as {args.format}{" (gzip)" if args.gzip else ""}: '
+              f'{size / 1e6:.1f} MB in {chunks} chunks, {elapsed:.2f}s')
+        print(f'Throughput: {args.rows / elapsed:,.0f} rows/s, {size / 1e6 / elapsed:.1f} MB/s')
+        print(f'Peak RSS: {rss_before:.0f} MB before export, {peak_rss_mb():.0f} MB after')
+
+
+if __name__ == '__main__':
+    main()
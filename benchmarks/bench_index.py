@@ -0,0 +1,92 @@
+"""Compare recall and latency of the IVF face index against brute force.
+
+Uses synthetic 128-d encodings: enrolled faces are random vectors with
+roughly the spread of dlib encodings, probes are enrolled faces plus noise
+(a genuine match well inside the 0.6 tolerance) and unrelated impostors.
+
+    python benchmarks/bench_index.py --sizes 10000 50000 --probes 4 8 16
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import FaceGallery, ENCODING_SIZE
+from face_index import create_index
+
+
+def synthetic_rows(count, rng):
+    encodings = rng.normal(0.0, 0.09, size=(count, ENCODING_SIZE)).astype(np.float32)
+    return encodings, [(user_id, f'user{user_id}', f'user{user_id}@example.com', None)
+                       for user_id in range(1, count + 1)]
+
+
+def build_gallery(encodings, rows, index):
+    gallery = FaceGallery()
+    for (user_id, name, email, _), encoding in zip(rows, encodings):
+        gallery.add(user_id, name, email, encoding)
+    gallery.set_index(index)
+    return gallery
+
+
+def probe_set(encodings, queries, rng, noise=0.35):
+    picks = rng.choice(len(encodings), queries, replace=False)
+    direction = rng.normal(size=(queries, ENCODING_SIZE)).astype(np.float32)
+    direction *= noise / np.linalg.norm(direction, axis=1, keepdims=True)
+    genuine = encodings[picks] + direction
+    impostors = rng.normal(0.0, 0.09, size=(queries // 4, ENCODING_SIZE)).astype(np.float32)
+    return np.vstack([genuine, impostors])
+
+
+def timed_matches(gallery, probes, batch):
+    results = []
+    start = time.perf_counter()
+    for offset in range(0, len(probes), batch):
+        results.extend(gallery.match(probes[offset:offset + batch]))
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def same_result(a, b):
+    return (a is None and b is None) or (a is not None and b is not None and a.user_id == b.user_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--probes', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--queries', type=int, default=400)
+    parser.add_argument('--batch', type=int, default=1, help='Faces matched per call')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'size':>8} {'index':>10} {'build s':>9} {'ms/face':>9} {'speedup':>8} {'recall':>7}")
+
+    for size in args.sizes:
+        encodings, rows = synthetic_rows(size, rng)
+        probes = probe_set(encodings, args.queries, rng)
+
+        brute = build_gallery(encodings, rows, create_index('brute'))
+        expected, brute_time = timed_matches(brute, probes, args.batch)
+        brute_ms = 1000 * brute_time / len(probes)
+        print(f"{size:>8} {'brute':>10} {'-':>9} {brute_ms:>9.3f} {1.0:>8.1f} {1.0:>7.3f}")
+
+        for n_probe in args.probes:
+            index = create_index('ivf', n_probe=n_probe)
+            start = time.perf_counter()
+            gallery = build_gallery(encodings, rows, index)
+            build_time = time.perf_counter() - start
+
+            found, ivf_time = timed_matches(gallery, probes, args.batch)
+            recall = np.mean([same_result(a, b) for a, b in zip(expected, found)])
+            ivf_ms = 1000 * ivf_time / len(probes)
+            print(f"{size:>8} {'ivf/' + str(n_probe):>10} {build_time:>9.2f} {ivf_ms:>9.3f} "
+                  f"{brute_ms / ivf_ms:>8.1f} {recall:>7.3f}")
+
+
+if __name__ == '__main__':
+    main()
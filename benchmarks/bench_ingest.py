@@ -0,0 +1,108 @@
+"""Measure upload size and server-side preparation time of camera frames.
+
+Compares what reaches face detection for one camera frame sent as:
+
+    full        the camera resolution at JPEG quality 0.95, decoded at full size
+    reduced     the same upload, decoded by libjpeg at 1/2, 1/4 or 1/8 size
+    reduced+roi the same upload with a face region, cropped after the reduced decode
+    client      scaled in the browser to the detection budget at quality 0.8
+    client+roi  the client frame plus the face region found by the browser
+
+"prepare ms" covers decoding, cropping and the resize to the detection
+budget, i.e. everything before the detector runs. Pass --image to use a real
+photo instead of the synthetic frame:
+
+    python benchmarks/bench_ingest.py --width 1920 --height 1080
+"""
+import argparse
+import math
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from face_utils import DEFAULT_INGEST, DetectionSettings, detection_scale, ingest_image
+
+
+def synthetic_frame(width, height, rng):
+    """A smooth background with a bright face-sized blob and sensor noise"""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    frame = np.empty((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        frame[..., channel] = 90 + 40 * np.sin(x / (80 + 30 * channel)) * np.cos(y / 120)
+    cy, cx, radius = height / 2, width / 2, height / 5
+    frame[(x - cx) ** 2 + (y - cy) ** 2 < radius ** 2] += 70
+    frame += rng.normal(0, 6, size=frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def centered_box(height, width):
+    """(top, right, bottom, left) of a square face box in the middle of the frame"""
+    side = round(height * 2 / 5)
+    return (height - side) // 2, (width + side) // 2, (height + side) // 2, (width - side) // 2
+
+
+def encode(frame, quality):
+    return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def prepare(image_data, ingest, detection, roi=None):
+    frame, origin = ingest_image(image_data, ingest, detection, roi)
+    height, width = frame.shape[:2]
+    scale = detection_scale(height, width, detection.max_pixels)
+    if scale < 1.0:
+        frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def measure(label, image_data, ingest, detection, repeat, roi=None):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frame = prepare(image_data, ingest, detection, roi)
+        timings.append(time.perf_counter() - start)
+    print(f"{label:>12} {len(image_data) / 1024:>9.1f} {1000 * np.median(timings):>11.2f} "
+          f"{frame.shape[1]:>6}x{frame.shape[0]:<6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--image', help='Use this photo as the camera frame')
+    parser.add_argument('--max-pixels', type=int, default=Config.FACE_DETECTION_MAX_PIXELS,
+                        help='Detection budget (FACE_DETECTION_MAX_PIXELS)')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.image:
+        frame = cv2.imread(args.image, cv2.IMREAD_COLOR)
+    else:
+        frame = synthetic_frame(args.width, args.height, np.random.default_rng(args.seed))
+    height, width = frame.shape[:2]
+    detection = DetectionSettings(max_pixels=args.max_pixels, upsample=1, model='hog', landmarks='small',
+                                  rgb_input=False)
+
+    # What the browser sends: the frame scaled to the budget, and the face box found in it
+    scale = min(1.0, math.sqrt(args.max_pixels / (width * height)))
+    client = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    roi = centered_box(client.shape[0], client.shape[1])
+
+    full = encode(frame, 95)
+    client_data = encode(client, 80)
+    print(f'{width}x{height} frame, detection budget {args.max_pixels} pixels (median of {args.repeat})')
+    print(f"{'case':>12} {'KB':>9} {'prepare ms':>11} {'detector input':>14}")
+    measure('full', full, DEFAULT_INGEST._replace(reduced_decode=False), detection, args.repeat)
+    measure('reduced', full, DEFAULT_INGEST, detection, args.repeat)
+    measure('reduced+roi', full, DEFAULT_INGEST, detection, args.repeat, roi=centered_box(height, width))
+    measure('client', client_data, DEFAULT_INGEST, detection, args.repeat)
+    measure('client+roi', client_data, DEFAULT_INGEST, detection, args.repeat, roi=roi)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""Measure recognition latency per stage and throughput against synthetic galleries.
+
+Seeds a throwaway SQLite database with N synthetic users (random 128-d
+encodings), enrolls the faces found in the fixture images among them, then
+replays the fixtures through:
+
+    stages          decode, detect, encode, match and db timed separately
+    recognize_face  face_utils.recognize_face on the decoded frame
+    camera          Camera.process_image
+    endpoint        POST /process_attendance through the Flask test client
+
+for every gallery size and concurrency level. The db stage is the attendance
+write of a recognized frame: the cooldown check plus the bulk insert flush.
+Results are written as JSON so runs on different commits can be compared:
+
+    python benchmarks/bench_recognition.py --fixtures faces/ --sizes 1000 10000 100000 --concurrency 1 4
+    python benchmarks/bench_recognition.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TARGETS = ['stages', 'recognize_face', 'camera', 'endpoint']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_fixtures(directory, rng):
+    """Encoded images from a directory, or random noise frames when none are given"""
+    if directory:
+        fixtures = []
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    fixtures.append(f.read())
+        if fixtures:
+            return fixtures
+        print(f'No images found in {directory}')
+
+    import cv2
+    print('Using random noise frames: no faces are detected, so encode is skipped '
+          'and match runs on a random encoding')
+    frames = rng.integers(0, 256, size=(4, 480, 640, 3), dtype=np.uint8)
+    return [cv2.imencode('.jpg', frame)[1].tobytes() for frame in frames]
+
+
+def summarize(samples):
+    values = np.asarray(samples) * 1000.0
+    return {
+        'count': len(values),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3)
+    }
+
+
+class Harness:
+    def __init__(self, database, workers, tracking):
+        os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+        os.environ['RECOGNITION_WORKERS'] = str(workers)
+        from app import create_app
+        from camera import camera
+        from config import Config
+
+        # Keep the snapshot, index and profiles of the throwaway database out of instance/
+        directory = os.path.dirname(database)
+
+        class BenchConfig(Config):
+            GALLERY_SNAPSHOT_PATH = os.path.join(directory, 'gallery')
+            FACE_INDEX_PATH = os.path.join(directory, 'face_index.npz')
+            PROFILE_DIR = os.path.join(directory, 'profiles')
+
+        self.app = create_app(BenchConfig)
+        self.camera = camera
+        self.database = database
+        if not tracking:
+            # Every replayed frame is encoded instead of reusing the previous one's identity
+            camera.configure_tracking(0)
+        # Learning templates would add database writes to the measured requests
+        camera.configure_templates(1)
+        self.fixture_encodings = []
+        self._db_users = itertools.count()
+        self._clients = threading.local()
+
+    def enroll_fixtures(self, fixtures):
+        """Encode the first face of every fixture so replays produce genuine matches"""
+        from face_utils import analyze_frame, decode_image
+        for image_data in fixtures:
+            faces = analyze_frame(decode_image(image_data, rgb=self.camera.detection.rgb_input), self.camera.detection)
+            if faces:
+                self.fixture_encodings.append(np.asarray(faces[0].encoding, dtype=np.float32))
+        print(f'{len(self.fixture_encodings)} of {len(fixtures)} fixtures contain a face')
+
+    def seed(self, size, rng):
+        """Replace every user with size users and reload the gallery from the database"""
+        import encoding_format
+        from models import User, FaceTemplate
+
+        encodings = rng.normal(0.0, 0.09, size=(size, 128)).astype(np.float32)
+        for row, encoding in enumerate(self.fixture_encodings[:size]):
+            encodings[row] = encoding
+
+        connection = sqlite3.connect(self.database)
+        connection.execute('DELETE FROM face_template')
+        connection.execute('DELETE FROM attendance')
+        connection.execute('DELETE FROM user')
+        connection.executemany(
+            'INSERT INTO user (id, name, email, custom_data, face_encoding, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            ((i + 1, f'User {i + 1}', f'user{i + 1}@example.com', None, encoding_format.pack(encoding),
+              '2024-01-01 00:00:00') for i, encoding in enumerate(encodings))
+        )
+        connection.commit()
+        connection.close()
+
+        with self.app.app_context():
+            self.camera.load_gallery(User.gallery_rows(), FaceTemplate.gallery_rows())
+        self.size = size
+
+    def reset_cooldowns(self):
+        from attendance_log import attendance_log
+        attendance_log.flush()
+        attendance_log.prune(datetime.utcnow() + attendance_log.cooldown)
+
+    def run_stages(self, image_data, rng):
+        from attendance_log import attendance_log
+        from face_utils import decode_image, detect_faces, load_models
+        settings = self.camera.detection
+        times = {}
+
+        start = time.perf_counter()
+        frame = decode_image(image_data, rgb=settings.rgb_input)
+        times['decode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        small_frame, locations, scale = detect_faces(frame, settings)
+        times['detect'] = time.perf_counter() - start
+
+        if locations:
+            start = time.perf_counter()
+            encodings = load_models().face_encodings(small_frame, locations, model=settings.landmarks)
+            times['encode'] = time.perf_counter() - start
+        else:
+            encodings = rng.normal(0.0, 0.09, size=(1, 128)).astype(np.float32)
+
+        start = time.perf_counter()
+        self.camera.gallery.match(encodings)
+        times['match'] = time.perf_counter() - start
+
+        # A different user every frame so the cooldown never skips the write
+        user_id = next(self._db_users) % self.size + 1
+        start = time.perf_counter()
+        attendance_log.check_in(user_id)
+        attendance_log.flush()
+        times['db'] = time.perf_counter() - start
+        return times
+
+    def run_recognize_face(self, image_data, rng):
+        from face_utils import decode_image, recognize_face
+        start = time.perf_counter()
+        recognize_face(decode_image(image_data, rgb=self.camera.detection.rgb_input), self.camera.gallery, settings=self.camera.detection)
+        return {'total': time.perf_counter() - start}
+
+    def run_camera(self, image_data, rng):
+        start = time.perf_counter()
+        self.camera.process_image(image_data)
+        return {'total': time.perf_counter() - start}
+
+    def run_endpoint(self, image_data, rng):
+        import io
+        # One test client (and so one kiosk session) per thread
+        if not hasattr(self._clients, 'client'):
+            self._clients.client = self.app.test_client()
+        start = time.perf_counter()
+        response = self._clients.client.post('/process_attendance',
+                                       data={'image': (io.BytesIO(image_data), 'frame.jpg')},
+                                       content_type='multipart/form-data')
+        elapsed = time.perf_counter() - start
+        return {'total': elapsed, 'status': response.status_code}
+
+    def run(self, target, fixtures, requests, concurrency, seed):
+        """Replay the fixtures requests times on concurrency threads"""
+        self.reset_cooldowns()
+        step = getattr(self, 'run_' + target)
+
+        def replay(i):
+            rng = np.random.default_rng(seed + i)
+            return step(fixtures[i % len(fixtures)], rng)
+
+        # Warm up outside the measurement (pool start, first dlib call)
+        replay(0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(replay, range(requests)))
+        elapsed = time.perf_counter() - start
+
+        stages = {}
+        statuses = {}
+        for result in results:
+            status = result.pop('status', None)
+            if status is not None:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            for stage, seconds in result.items():
+                stages.setdefault(stage, []).append(seconds)
+        if target == 'stages':
+            stages['total'] = [sum(result.values()) for result in results]
+
+        run = {
+            'target': target,
+            'size': self.size,
+            'concurrency': concurrency,
+            'requests': requests,
+            'throughput_rps': round(requests / elapsed, 2),
+            'stages': {stage: summarize(samples) for stage, samples in stages.items()}
+        }
+        if statuses:
+            run['status_codes'] = statuses
+        return run
+
+
+def print_run(run):
+    for stage, summary in run['stages'].items():
+        print(f"{run['target']:>15} {run['size']:>7} {run['concurrency']:>5} {stage:>7} "
+              f"{summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} {summary['p99_ms']:>9.2f} "
+              f"{run['throughput_rps'] if stage == 'total' else '':>9}")
+
+
+def run_key(run, stage):
+    return run['target'], run['size'], run['concurrency'], stage
+
+
+def compare(baseline_path, current):
+    """Print p50/p95 and throughput changes of matching runs against a baseline file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {}
+    for run in baseline['runs']:
+        for stage, summary in run['stages'].items():
+            previous[run_key(run, stage)] = (summary, run['throughput_rps'])
+
+    print(f"\nCompared with {baseline.get('commit') or baseline_path}:")
+    print(f"{'target':>15} {'size':>7} {'conc':>5} {'stage':>7} {'p50 %':>8} {'p95 %':>8} {'rps %':>8}")
+    for run in current['runs']:
+        for stage, summary in run['stages'].items():
+            if run_key(run, stage) not in previous:
+                continue
+            old, old_rps = previous[run_key(run, stage)]
+
+            def change(new, old):
+                return 100.0 * (new - old) / old if old else 0.0
+            print(f"{run['target']:>15} {run['size']:>7} {run['concurrency']:>5} {stage:>7} "
+                  f"{change(summary['p50_ms'], old['p50_ms']):>+8.1f} {change(summary['p95_ms'], old['p95_ms']):>+8.1f} "
+                  f"{change(run['throughput_rps'], old_rps):>+8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', help='Directory of face images to replay')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS)
+    parser.add_argument('--requests', type=int, default=200, help='Frames replayed per run')
+    parser.add_argument('--workers', type=int, default=0, help='RECOGNITION_WORKERS for camera and endpoint')
+    parser.add_argument('--tracking', action='store_true', help='Keep face tracking on between replayed frames')
+    parser.add_argument('--output', help='JSON results file (default benchmarks/results/recognition-<commit>.json)')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='Baseline results to compare against; with two files, compare them without running')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as f:
+            compare(args.compare[0], json.load(f))
+        return
+
+    rng = np.random.default_rng(args.seed)
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'created': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'runs': []
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        harness = Harness(os.path.join(directory, 'bench.db'), args.workers, args.tracking)
+        fixtures = load_fixtures(args.fixtures, rng)
+        harness.enroll_fixtures(fixtures)
+
+        print(f"{'target':>15} {'size':>7} {'conc':>5} {'stage':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+        for size in args.sizes:
+            harness.seed(size, rng)
+            for concurrency in args.concurrency:
+                for target in args.targets:
+                    run = harness.run(target, fixtures, args.requests, concurrency, args.seed)
+                    results['runs'].append(run)
+                    print_run(run)
+        # Write what the endpoint buffered while the database still exists
+        harness.reset_cooldowns()
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f'recognition-{commit or "local"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults written to {output}')
+
+    if args.compare:
+        compare(args.compare[0], results)
+
+
+if __name__ == '__main__':
+    main()
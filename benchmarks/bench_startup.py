@@ -0,0 +1,122 @@
+"""Measure time to first request of a fresh process, with and without a gallery snapshot.
+
+Seeds a throwaway SQLite database with synthetic users, then starts new
+Python processes that import the app, create it and serve one
+/process_attendance request:
+
+    cold      no saved gallery snapshot, encodings are read from the database
+    snapshot  the gallery snapshot saved by the cold start is memory mapped
+
+--ref also times an older commit (checked out in a temporary git worktree)
+the same way, for a before/after comparison:
+
+    python benchmarks/bench_startup.py --users 100000 --ref HEAD~1
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Runs in the measured process; works with the app factory and the older module-level app
+PROBE = '''
+import io, json, time
+start = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+application = module.create_app() if hasattr(module, 'create_app') else module.app
+created = time.perf_counter()
+import cv2, numpy as np
+image = cv2.imencode('.jpg', np.full((480, 640, 3), 128, np.uint8))[1].tobytes()
+response = application.test_client().post('/process_attendance', data={'image': (io.BytesIO(image), 'frame.jpg')},
+                                          content_type='multipart/form-data')
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create': created - imported,
+                  'first_request': served - created, 'total': served - start, 'status': response.status_code}))
+'''
+
+
+def seed(path, users, rng):
+    """Create the schema through the models, then bulk insert with sqlite3"""
+    from flask import Flask
+    import encoding_format
+    from models import db
+
+    app = Flask('seed')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+
+    encodings = rng.normal(0.0, 0.09, size=(users, 128)).astype(np.float32)
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        'INSERT INTO user (id, name, email, custom_data, face_encoding, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+        ((i + 1, f'User {i + 1}', f'user{i + 1}@example.com', None, encoding_format.pack(encoding),
+          '2024-01-01 00:00:00') for i, encoding in enumerate(encodings))
+    )
+    connection.commit()
+    connection.close()
+
+
+def probe(source, environment):
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=source, env=environment)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure(label, source, environment, repeat, before_each=None):
+    runs = []
+    for _ in range(repeat):
+        if before_each:
+            before_each()
+        runs.append(probe(source, environment))
+    median = {key: float(np.median([run[key] for run in runs])) for key in ('import', 'create', 'first_request', 'total')}
+    print(f"{label:>16} {median['import']:>9.3f} {median['create']:>9.3f} "
+          f"{median['first_request']:>9.3f} {median['total']:>9.3f}")
+    return median
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3, help='Starts per case (the median is reported)')
+    parser.add_argument('--workers', type=int, default=0, help='RECOGNITION_WORKERS of the measured process')
+    parser.add_argument('--ref', help='Also time this older commit')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'startup.db')
+        snapshot = os.path.join(directory, 'gallery')
+        seed(database, args.users, np.random.default_rng(args.seed))
+        environment = dict(os.environ, DATABASE_URL=f'sqlite:///{database}', GALLERY_SNAPSHOT_PATH=snapshot,
+                           RECOGNITION_WORKERS=str(args.workers))
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))
+
+        print(f'{args.users} users, seconds (median of {args.repeat})')
+        print(f"{'case':>16} {'import':>9} {'create':>9} {'1st req':>9} {'total':>9}")
+
+        if args.ref:
+            worktree = os.path.join(directory, 'ref')
+            subprocess.check_call(['git', 'worktree', 'add', '--detach', '--quiet', worktree, args.ref], cwd=ROOT)
+            try:
+                ref_environment = dict(environment)
+                ref_environment['PYTHONPATH'] = os.pathsep.join(filter(None, [worktree, os.environ.get('PYTHONPATH')]))
+                measure(args.ref, worktree, ref_environment, args.repeat)
+            finally:
+                subprocess.check_call(['git', 'worktree', 'remove', '--force', worktree], cwd=ROOT)
+
+        measure('cold', ROOT, environment, args.repeat,
+                before_each=lambda: shutil.rmtree(snapshot, ignore_errors=True))
+        measure('snapshot', ROOT, environment, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
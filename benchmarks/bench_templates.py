@@ -0,0 +1,120 @@
+"""Measure first-match rate and matching cost as templates per user grow.
+
+Uses synthetic 128-d encodings: every identity has a few capture conditions
+(lighting, pose) that each shift its encoding, plus per-capture noise. Users
+enroll under one condition; extra templates come from captures under other
+conditions, as the learning in Camera.template_candidate would add them.
+Probes are single frames under a random condition, so the first-match rate is
+the fraction of genuine frames recognized without a retry.
+
+--wide gives a fraction of users pairs of templates far on either side of
+their centroid, so their lower bound is much smaller than their real
+distance. "exact" is the fraction of probes for which FaceGallery.match
+agrees with an exhaustive search over every template of every user.
+
+    python benchmarks/bench_templates.py --users 5000 --templates 1 2 3 5 8 --wide 0.05
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import FaceGallery, ENCODING_SIZE
+
+
+def random_offsets(shape, norm, rng):
+    offsets = rng.normal(size=shape + (ENCODING_SIZE,)).astype(np.float32)
+    offsets *= norm / np.linalg.norm(offsets, axis=-1, keepdims=True)
+    return offsets
+
+
+def synthetic_identities(users, conditions, condition_shift, rng):
+    centers = rng.normal(0.0, 0.09, size=(users, ENCODING_SIZE)).astype(np.float32)
+    shifts = random_offsets((users, conditions), condition_shift, rng)
+    return centers, shifts
+
+
+def captures(centers, shifts, users, conditions, noise, rng):
+    return centers[users] + shifts[users, conditions] + random_offsets((len(users),), noise, rng)
+
+
+def build_gallery(centers, shifts, templates, noise, rng, wide=0.0, wide_radius=0.6):
+    users = np.arange(len(centers))
+    gallery = FaceGallery()
+    enrollment = captures(centers, shifts, users, np.zeros(len(users), dtype=int), noise, rng)
+    for user in users:
+        gallery.add(int(user) + 1, f'user{user + 1}', f'user{user + 1}@example.com', enrollment[user])
+    if templates > 1:
+        extra = [captures(centers, shifts, users, np.full(len(users), k), noise, rng) for k in range(1, templates)]
+        for user in users:
+            gallery.set_templates(int(user) + 1, [enrollment[user]] + [learned[user] for learned in extra])
+    # Spread-out users: templates in opposite directions keep the centroid near the identity
+    for user in rng.choice(users, int(wide * len(users)), replace=False):
+        offsets = random_offsets((max(templates // 2, 1),), wide_radius, rng)
+        gallery.set_templates(int(user) + 1, np.vstack([centers[user] + offsets, centers[user] - offsets]))
+    return gallery
+
+
+def exhaustive_match(gallery, users, probes, tolerance=0.6):
+    """Closest user by the minimum over all of their templates, or None past tolerance"""
+    owners = []
+    stacked = []
+    for user in range(1, users + 1):
+        templates = gallery.templates(user)
+        owners.extend([user] * len(templates))
+        stacked.append(templates)
+    owners = np.array(owners)
+    stacked = np.vstack(stacked)
+    results = []
+    for probe in probes:
+        distances = np.linalg.norm(stacked - probe, axis=1)
+        nearest = np.argmin(distances)
+        results.append(int(owners[nearest]) if distances[nearest] <= tolerance else None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--templates', type=int, nargs='+', default=[1, 2, 3, 5, 8])
+    parser.add_argument('--conditions', type=int, default=8, help='Capture conditions per identity')
+    parser.add_argument('--condition-shift', type=float, default=0.35)
+    parser.add_argument('--noise', type=float, default=0.2)
+    parser.add_argument('--wide', type=float, default=0.05, help='Fraction of users with spread-out templates')
+    parser.add_argument('--wide-radius', type=float, default=0.9)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers, shifts = synthetic_identities(args.users, args.conditions, args.condition_shift, rng)
+
+    probe_users = rng.choice(args.users, args.queries)
+    probe_conditions = rng.integers(0, args.conditions, args.queries)
+    genuine = captures(centers, shifts, probe_users, probe_conditions, args.noise, rng)
+    impostors = rng.normal(0.0, 0.09, size=(args.queries // 4, ENCODING_SIZE)).astype(np.float32)
+
+    print(f"{'K':>3} {'first match':>12} {'wrong id':>9} {'false acc':>10} {'exact':>7} {'ms/frame':>9} {'MB':>7}")
+    for templates in args.templates:
+        gallery = build_gallery(centers, shifts, templates, args.noise, rng, args.wide, args.wide_radius)
+
+        start = time.perf_counter()
+        results = [gallery.match(probe[None, :])[0] for probe in genuine]
+        elapsed = time.perf_counter() - start
+        impostor_results = [gallery.match(probe[None, :])[0] for probe in impostors]
+
+        first_match = np.mean([r is not None and r.user_id == user + 1 for r, user in zip(results, probe_users)])
+        wrong = np.mean([r is not None and r.user_id != user + 1 for r, user in zip(results, probe_users)])
+        false_accept = np.mean([r is not None for r in impostor_results])
+        expected = exhaustive_match(gallery, args.users, np.vstack([genuine, impostors]))
+        exact = np.mean([(r.user_id if r else None) == e for r, e in zip(results + impostor_results, expected)])
+        memory = (gallery.capacity + args.users * templates * (templates > 1)) * ENCODING_SIZE * 4 / 1e6
+        print(f"{templates:>3} {first_match:>12.3f} {wrong:>9.3f} {false_accept:>10.3f} {exact:>7.3f} "
+              f"{1000 * elapsed / len(genuine):>9.3f} {memory:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
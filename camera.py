@@ -1,54 +1,285 @@
-import cv2
-import numpy as np
-from face_utils import recognize_face, get_face_encoding
+import multiprocessing
+import threading
+import time
+import gallery_store
+from face_utils import (recognize_tracked, recognize_faces_batch, get_face_encoding, ingest_image, check_image_size,
+                        ImageTooLarge, DEFAULT_DETECTION, DEFAULT_INGEST)
+from face_tracker import FaceTracker
+from gallery import FaceGallery
+from metrics import metrics, profiler
+from recognition_pool import RecognitionPool, PoolBusy, decode_images
 
 class Camera:
     def __init__(self):
         self.recognized_user = None
-        self.users = []
+        self.gallery = FaceGallery()
+        self.detection = DEFAULT_DETECTION
+        self.ingest = DEFAULT_INGEST
+        self.tracker = FaceTracker()
+        self.pool = None
+        self.pool_options = None
+        self.pool_timeout = None
+        self.snapshot_file = None
+        self._pool_lock = threading.Lock()
+        self.max_templates = 1
+        self.learn_distance = 0.0
+        self.learn_diversity = 0.0
+        self.learn_interval = 0.0
+        self._learned_at = {}
     
-    def update_users(self, users):
-        """Update the list of users for recognition"""
-        self.users = users
+    def configure_detection(self, settings):
+        """Use the same DetectionSettings for registration and attendance"""
+        self.detection = settings
     
-    def process_image(self, image_data):
-        """Process an image from the frontend and recognize faces"""
-        # Convert base64 image to numpy array
+    def configure_ingest(self, settings):
+        """Use IngestSettings to limit and downsize uploaded images before recognition"""
+        self.ingest = settings
+    
+    def configure_tracking(self, ttl, iou_threshold=0.5, max_hash_distance=10):
+        """Reuse identities across a client's frames for ttl seconds (0 disables)"""
+        self.tracker = FaceTracker(ttl, iou_threshold, max_hash_distance)
+    
+    def configure_templates(self, max_templates, learn_distance=0.4, min_diversity=0.2, interval=3600):
+        """Learn up to max_templates encodings per user from confident recognitions.
+
+        A recognized face becomes a new template when it matched within
+        learn_distance yet is at least min_diversity away from every template
+        the user already has, at most once per user every interval seconds.
+        """
+        self.max_templates = max_templates
+        self.learn_distance = learn_distance
+        self.learn_diversity = min_diversity
+        self.learn_interval = interval
+    
+    def start_workers(self, workers, queue_size=0, timeout=None):
+        """Run recognition on a pool of worker processes instead of the request thread.
+
+        The pool is started on the first recognition so that CLI commands and
+        the workers themselves (which re-import the main module) never spawn one.
+        """
+        if workers <= 0 or multiprocessing.parent_process() is not None:
+            return
+        self.pool_options = (workers, queue_size)
+        self.pool_timeout = timeout
+    
+    def _get_pool(self):
+        if self.pool is None and self.pool_options:
+            with self._pool_lock:
+                if self.pool is None:
+                    workers, queue_size = self.pool_options
+                    self.pool = RecognitionPool(self.gallery, self.detection, workers, queue_size,
+                                                snapshot_file=self.snapshot_file, ingest=self.ingest)
+        return self.pool
+    
+    def _publish(self, operation, *args):
+        """Forward a gallery change to the worker processes"""
+        if self.pool:
+            self.pool.publish(operation, *args)
+    
+    def set_index(self, index):
+        """Use a different search index for the face gallery"""
+        self.gallery.set_index(index)
+    
+    def load_gallery(self, rows, template_rows=()):
+        """Rebuild the face gallery from (id, name, email, encoding blob) rows
+        and (user_id, encoding blob) rows of learned templates"""
+        self.gallery.load_rows(rows, template_rows)
+        if self.pool:
+            self.pool.reload()
+    
+    def load_snapshot(self, path, stamp):
+        """Load the face gallery from a snapshot saved on disk for this database stamp.
+
+        Returns False when there is no such snapshot (missing or stale).
+        """
+        snapshot = gallery_store.load(path, stamp)
+        if snapshot is None:
+            return False
+        self.gallery.load_snapshot(snapshot, copy=False)
+        self.snapshot_file = (path, stamp, self.gallery.version)
+        if self.pool:
+            self.pool.snapshot_file = self.snapshot_file
+            self.pool.reload()
+        return True
+    
+    def save_snapshot(self, path, stamp):
+        """Save the face gallery so the next start (and the workers) can map it"""
+        version = self.gallery.version
+        try:
+            gallery_store.save(path, self.gallery.snapshot(), stamp)
+        except OSError as e:
+            print(f"Error saving gallery snapshot: {e}")
+            return
+        self.snapshot_file = (path, stamp, version)
+        if self.pool:
+            self.pool.snapshot_file = self.snapshot_file
+    
+    def add_user(self, user):
+        """Add a newly registered user to the face gallery"""
+        encoding = user.get_face_encoding()
+        self.gallery.add(user.id, user.name, user.email, encoding)
+        self._publish('add', user.id, user.name, user.email, encoding)
+    
+    def remove_user(self, user_id):
+        """Drop a deleted user from the face gallery"""
+        self.gallery.remove(user_id)
+        self._publish('remove', user_id)
+    
+    def set_user_templates(self, user):
+        """Match a user against their enrollment encoding and learned templates"""
+        templates = user.get_face_templates()
+        self.gallery.set_templates(user.id, templates)
+        self._publish('set_templates', user.id, templates)
+    
+    def template_candidate(self, face, now=None):
+        """The encoding of a recognized face if it should become a new template, else None"""
+        if self.max_templates <= 1 or face.encoding is None or face.match is None:
+            return None
+        if face.match.distance > self.learn_distance:
+            return None
+        now = now or time.monotonic()
+        user_id = face.match.user_id
+        if now - self._learned_at.get(user_id, -self.learn_interval) < self.learn_interval:
+            return None
+        distance = self.gallery.template_distance(user_id, face.encoding)
+        if distance is None or distance < self.learn_diversity:
+            return None
+        self._learned_at[user_id] = now
+        return face.encoding
+    
+    def update_user(self, user):
+        """Refresh the name and email shown for a user; face data is left untouched"""
+        self.gallery.update_metadata(user.id, user.name, user.email)
+        self._publish('update_metadata', user.id, user.name, user.email)
+    
+    def process_image(self, image_data, client_id=None, roi=None):
+        """Process an image from the frontend and recognize faces.
+
+        client_id identifies the kiosk session whose recent faces may be reused.
+        roi is an optional (top, right, bottom, left) face region found by the
+        client; the image is still decoded whole, but only that region is searched.
+        """
+        metrics.count('frames')
+        metrics.count('image_bytes', len(image_data))
         try:
-            # Decode the image data
-            nparr = np.frombuffer(image_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            tracker = self.tracker
+            tracks = tracker.tracks_for(client_id, self.gallery)
+            pool = self._get_pool()
+            with metrics.timer('recognize'):
+                if pool:
+                    # Decode and recognize in a worker process, oversized payloads are not sent there
+                    check_image_size(image_data, self.ingest)
+                    faces = pool.recognize(image_data, tracks, tracker.iou_threshold,
+                                           tracker.max_hash_distance, timeout=self.pool_timeout, roi=roi)
+                else:
+                    with profiler.sample('recognize'):
+                        frame, origin = ingest_image(image_data, self.ingest, self.detection, roi)
+                        faces = recognize_tracked(frame, self.gallery, tracks, settings=self.detection,
+                                                  iou_threshold=tracker.iou_threshold,
+                                                  max_hash_distance=tracker.max_hash_distance,
+                                                  origin=origin)
+            tracker.update(client_id, faces)
+            metrics.count('faces', len(faces))
+            metrics.count('matches', sum(1 for face in faces if face.match))
             
-            # Try to recognize faces
-            user, face_location = recognize_face(frame, self.users)
+            face = next((face for face in faces if face.match), None)
             
-            if user:
+            if face:
+                match = face.match
                 return {
                     'recognized': True,
-                    'user_id': user.id,
-                    'name': user.name,
-                    'email': user.email
+                    'user_id': match.user_id,
+                    'name': match.name,
+                    'email': match.email,
+                    'new_template': self.template_candidate(face)
                 }
             else:
                 return {
                     'recognized': False
                 }
+        except PoolBusy:
+            metrics.count('busy')
+            return {
+                'recognized': False,
+                'busy': True
+            }
+        except ImageTooLarge as e:
+            metrics.count('rejected')
+            return {
+                'recognized': False,
+                'error': str(e),
+                'too_large': True
+            }
         except Exception as e:
+            metrics.count('errors')
             print(f"Error processing image: {e}")
             return {
                 'recognized': False,
                 'error': str(e)
             }
     
+    def process_batch(self, images):
+        """Recognize faces in a batch of images with a single gallery match"""
+        metrics.count('frames', len(images))
+        metrics.count('image_bytes', sum(len(image_data) for image_data in images))
+        try:
+            pool = self._get_pool()
+            with metrics.timer('recognize_batch'):
+                if pool:
+                    # The whole batch goes to one worker
+                    results, errors = pool.recognize_batch(images, self.pool_timeout)
+                else:
+                    with profiler.sample('recognize_batch'):
+                        frames, origins, errors = decode_images(images, self.ingest, self.detection)
+                        results = recognize_faces_batch(frames, self.gallery, settings=self.detection,
+                                                        origins=origins)
+        except PoolBusy:
+            metrics.count('busy')
+            return {
+                'busy': True
+            }
+        except Exception as e:
+            metrics.count('errors')
+            print(f"Error processing batch: {e}")
+            return {
+                'images': [],
+                'error': str(e)
+            }
+        
+        metrics.count('faces', sum(len(faces) for faces in results))
+        metrics.count('matches', sum(1 for faces in results for match, location in faces if match))
+        metrics.count('errors', sum(1 for error in errors if error))
+        
+        images = []
+        for faces, error in zip(results, errors):
+            matched = [
+                {
+                    'user_id': match.user_id,
+                    'name': match.name,
+                    'email': match.email,
+                    'location': list(face_location)
+                }
+                for match, face_location in faces if match
+            ]
+            image = {
+                'recognized': bool(matched),
+                'faces': matched
+            }
+            if error:
+                image['error'] = error
+            images.append(image)
+        return {
+            'images': images
+        }
+    
     def capture_face_encoding(self, image_data):
         """Extract face encoding from uploaded image"""
         try:
-            # Decode the image data
-            nparr = np.frombuffer(image_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # Decode the image data, at reduced size when it is larger than detection needs
+            frame = ingest_image(image_data, self.ingest, self.detection)[0]
             
             # Get face encoding
-            result = get_face_encoding(frame)
+            result = get_face_encoding(frame, self.detection)
             if result:
                 face_encoding, face_location = result
                 return {
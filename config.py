@@ -5,3 +5,41 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///attendance.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     ATTENDANCE_COOLDOWN = 300  # 5 minutes in seconds
+    ATTENDANCE_FLUSH_INTERVAL = 2  # seconds between bulk inserts of new attendance
+    ATTENDANCE_MAX_PENDING = 500  # flush early once this many records are buffered
+    FACE_ENCODING_DTYPE = 'float32'  # float32 or float16 for stored encodings
+    FACE_INDEX = os.environ.get('FACE_INDEX') or 'brute'  # brute or ivf (approximate, for large enrollments)
+    FACE_INDEX_LISTS = None  # IVF partitions; defaults to sqrt(number of users)
+    FACE_INDEX_PROBES = 8  # IVF partitions searched per face
+    FACE_INDEX_PATH = None  # defaults to face_index.npz in the instance folder
+    FACE_DETECTION_MAX_PIXELS = 160 * 120  # downscale frames to this many pixels before detection (1/4 of 640x480; HOG cost grows with it)
+    FACE_DETECTION_UPSAMPLE = 1  # raise to find smaller faces at extra cost
+    FACE_DETECTION_MODEL = 'hog'  # hog or cnn
+    FACE_LANDMARK_MODEL = 'small'  # small (5 point) or large (68 point)
+    FACE_DETECTION_RGB_INPUT = False  # decode uploads straight to RGB instead of converting from BGR
+    RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', os.cpu_count() or 1))  # 0 runs in the request thread
+    RECOGNITION_QUEUE_SIZE = 4  # images allowed to wait for a busy worker before returning 503
+    RECOGNITION_TIMEOUT = 15  # seconds a request waits for its result
+    MAX_BATCH_IMAGES = 16  # images accepted by /process_attendance_batch
+    MAX_IMAGE_BYTES = 4 * 1024 * 1024  # larger uploaded images are rejected without decoding
+    MAX_IMAGE_PIXELS = 4096 * 4096  # images whose header declares more pixels are rejected
+    MAX_CONTENT_LENGTH = MAX_BATCH_IMAGES * MAX_IMAGE_BYTES  # request body limit (413 beyond it)
+    FACE_REDUCED_DECODE = True  # decode large JPEGs at 1/2, 1/4 or 1/8 size when detection would downscale anyway
+    FACE_ROI_MARGIN = 0.25  # grow a client-provided face region by this fraction on each side
+    ADMIN_PAGE_SIZE = 50  # rows per page on the admin dashboard
+    EXPORT_BATCH_SIZE = 1000  # rows fetched per batch when streaming exports
+    FACE_TRACK_TTL = 6  # seconds a kiosk reuses a recognized face without re-encoding (0 disables)
+    FACE_TRACK_IOU = 0.5  # minimum box overlap to treat a face as the same track
+    FACE_TRACK_HASH_DISTANCE = 10  # maximum differing bits of the 64-bit face crop hash
+    FACE_MAX_TEMPLATES = 5  # encodings kept per user, enrollment included (1 disables learning)
+    FACE_TEMPLATE_LEARN_DISTANCE = 0.4  # only matches at least this close teach a new template
+    FACE_TEMPLATE_MIN_DIVERSITY = 0.2  # a new template must differ this much from the user's others
+    FACE_TEMPLATE_LEARN_INTERVAL = 3600  # seconds between learned templates of one user
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'  # stage timers and counters at /metrics
+    METRICS_WINDOW = 60  # seconds covered by the recent latency quantiles
+    METRICS_ALLOW_REMOTE = False  # serve /metrics to hosts other than localhost
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # fraction of recognitions dumped with cProfile
+    PROFILE_DIR = None  # defaults to profiles/ in the instance folder
+    PROFILE_MAX_FILES = 50  # newest profile dumps kept
+    GALLERY_SNAPSHOT_PATH = os.environ.get('GALLERY_SNAPSHOT_PATH')  # defaults to gallery/ in the instance folder
+    FACE_MODELS_PRELOAD = False  # load the dlib models in the background at startup instead of on first use
@@ -0,0 +1,84 @@
+import io
+import pickle
+import struct
+import numpy as np
+
+# Stored face encodings are an 8 byte header followed by raw little-endian floats:
+#   magic (4s) | format version (B) | dtype code (B) | dimensions (H)
+HEADER = struct.Struct('<4sBBH')
+MAGIC = b'FENC'
+FORMAT_VERSION = 1
+
+# Dtype code in the header -> little-endian numpy dtype of the payload
+DTYPES = {
+    4: np.dtype('<f4'),
+    2: np.dtype('<f2'),
+}
+DTYPE_CODES = {'float32': 4, 'float16': 2}
+
+# Pickle globals a legacy ndarray blob is allowed to reference
+_LEGACY_PICKLE_GLOBALS = {
+    ('numpy', 'ndarray'),
+    ('numpy', 'dtype'),
+    ('numpy.core.multiarray', '_reconstruct'),
+    ('numpy._core.multiarray', '_reconstruct'),
+}
+
+
+class EncodingFormatError(ValueError):
+    """Raised when a stored face encoding cannot be decoded"""
+
+
+class _LegacyEncodingUnpickler(pickle.Unpickler):
+    """Unpickler that only rebuilds plain numpy arrays"""
+
+    def find_class(self, module, name):
+        if (module, name) in _LEGACY_PICKLE_GLOBALS:
+            return super().find_class(module, name)
+        raise EncodingFormatError(f'Refusing to unpickle {module}.{name} from a face encoding')
+
+
+def pack(encoding, dtype='float32'):
+    """Serialize a face encoding into the versioned binary format"""
+    code = DTYPE_CODES[dtype]
+    values = np.asarray(encoding, dtype=DTYPES[code]).ravel()
+    return HEADER.pack(MAGIC, FORMAT_VERSION, code, len(values)) + values.tobytes()
+
+
+def is_legacy(blob):
+    """True if the blob predates the versioned format and should be migrated"""
+    return bytes(blob[:len(MAGIC)]) != MAGIC
+
+
+def unpack(blob):
+    """Decode a stored face encoding into a float32 array.
+
+    Pickled float64 arrays and headerless float64 dumps from older versions
+    are still accepted so existing databases keep working until migrated.
+    """
+    if not is_legacy(blob):
+        magic, version, code, dims = HEADER.unpack_from(blob)
+        if version != FORMAT_VERSION or code not in DTYPES:
+            raise EncodingFormatError(f'Unsupported face encoding format v{version} dtype {code}')
+        values = np.frombuffer(blob, dtype=DTYPES[code], count=dims, offset=HEADER.size)
+        return values.astype(np.float32)
+
+    if bytes(blob[:1]) == b'\x80':
+        values = _LegacyEncodingUnpickler(io.BytesIO(blob)).load()
+        return np.asarray(values, dtype=np.float32)
+
+    if len(blob) % 8 == 0:
+        return np.frombuffer(blob, dtype='<f8').astype(np.float32)
+
+    raise EncodingFormatError('Unrecognized face encoding blob')
+
+
+def unpack_into(blob, out):
+    """Decode a stored face encoding straight into a preallocated float32 row"""
+    if not is_legacy(blob):
+        magic, version, code, dims = HEADER.unpack_from(blob)
+        if version == FORMAT_VERSION and code in DTYPES and dims == len(out):
+            out[:] = np.frombuffer(blob, dtype=DTYPES[code], count=dims, offset=HEADER.size)
+            return out
+    out[:] = unpack(blob)
+    return out
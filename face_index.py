@@ -0,0 +1,209 @@
+import os
+import numpy as np
+
+# Galleries smaller than this are always scanned exhaustively
+MIN_INDEXED_SIZE = 2048
+
+
+class BruteForceIndex:
+    """Exact search: every gallery row is a candidate"""
+
+    kind = 'brute'
+
+    # Nothing to save
+    modified = False
+
+    def reset(self, encodings, user_ids):
+        pass
+
+    def add(self, row, encoding):
+        pass
+
+    def remove(self, row, last):
+        """Drop ``row``; the gallery moves its ``last`` row into the freed slot"""
+        pass
+
+    def candidates(self, queries, count):
+        """Rows to score exactly for this batch of queries, or None for all rows"""
+        return None
+
+    def save(self, path, user_ids=None):
+        pass
+
+    def load(self, path):
+        return False
+
+
+class IVFIndex:
+    """Inverted-file index over k-means partitions of the gallery.
+
+    Each gallery row is assigned to its nearest centroid. A query probes the
+    ``n_probe`` closest partitions and only the rows in them are re-ranked
+    with exact distances by the gallery, so the 0.6 tolerance still applies
+    to true euclidean distances.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, n_lists=None, n_probe=8, iterations=15, sample_size=65536, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.seed = seed
+        self.centroids = None
+        self._active = False
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._count = 0
+        self._order = np.empty(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._trained_size = 0
+        self._saved_user_ids = None
+        self._saved_assignments = None
+        # Trained or assigned since it was last saved or loaded
+        self.modified = False
+
+    def _train(self, encodings):
+        """Fit centroids with Lloyd's algorithm on a sample of the gallery"""
+        rng = np.random.default_rng(self.seed)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(encodings))))
+        n_lists = min(n_lists, len(encodings))
+
+        sample = encodings
+        if len(sample) > self.sample_size:
+            sample = sample[rng.choice(len(sample), self.sample_size, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = self._nearest(sample, centroids, 1)[:, 0]
+            counts = np.bincount(labels, minlength=n_lists)
+            filled = counts > 0
+            # Sum each partition's members in one pass over the label-sorted sample
+            order = np.argsort(labels, kind='stable')
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            centroids[filled] = sums / counts[filled, None]
+
+        self.centroids = centroids
+        self._trained_size = len(encodings)
+
+    @staticmethod
+    def _nearest(vectors, centroids, k):
+        """Indices of the k closest centroids for every vector"""
+        distances = (np.einsum('ij,ij->i', centroids, centroids)[None, :]
+                     - 2.0 * (vectors @ centroids.T))
+        if k == 1:
+            return np.argmin(distances, axis=1)[:, None]
+        if k >= centroids.shape[0]:
+            return np.argsort(distances, axis=1)
+        return np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+    def reset(self, encodings, user_ids):
+        """Rebuild the partitions for a freshly loaded gallery"""
+        count = len(encodings)
+        if count < MIN_INDEXED_SIZE:
+            # Keep any trained or restored centroids for when the gallery is reloaded bigger
+            self._active = False
+            return
+
+        # Centroids loaded from disk are reused until the gallery doubles in size
+        if self.centroids is None or count > 2 * self._trained_size:
+            self._train(encodings)
+            assignments = None
+        elif self._saved_user_ids is not None and np.array_equal(self._saved_user_ids, user_ids):
+            assignments = self._saved_assignments
+        else:
+            assignments = None
+        self._saved_user_ids = None
+        self._saved_assignments = None
+
+        if assignments is None:
+            assignments = self._nearest(encodings, self.centroids, 1)[:, 0].astype(np.int32)
+            self.modified = True
+
+        self._assignments = np.empty(max(count, 64), dtype=np.int32)
+        self._assignments[:count] = assignments
+        self._count = count
+        self._active = True
+        self._rebuild_lists()
+
+    def _rebuild_lists(self):
+        """Lay the rows of every partition out contiguously (CSR style)"""
+        assignments = self._assignments[:self._count]
+        self._order = np.argsort(assignments, kind='stable')
+        self._offsets = np.searchsorted(assignments[self._order],
+                                        np.arange(len(self.centroids) + 1))
+
+    def add(self, row, encoding):
+        if not self._active:
+            return
+        if row >= len(self._assignments):
+            grown = np.empty(len(self._assignments) * 2, dtype=np.int32)
+            grown[:len(self._assignments)] = self._assignments
+            self._assignments = grown
+        self._assignments[row] = self._nearest(encoding[None, :], self.centroids, 1)[0, 0]
+        self._count = max(self._count, row + 1)
+        self._rebuild_lists()
+
+    def remove(self, row, last):
+        if not self._active:
+            return
+        self._assignments[row] = self._assignments[last]
+        self._count = last
+        self._rebuild_lists()
+
+    def candidates(self, queries, count):
+        if not self._active:
+            return None
+        probes = np.unique(self._nearest(queries, self.centroids, self.n_probe))
+        rows = [self._order[self._offsets[label]:self._offsets[label + 1]] for label in probes]
+        return np.sort(np.concatenate(rows))
+
+    def save(self, path, user_ids=None):
+        """Persist centroids (and row assignments for user_ids) to an .npz file"""
+        if not self._active:
+            return
+        count = 0 if user_ids is None else len(user_ids)
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path,
+            centroids=self.centroids,
+            trained_size=self._trained_size,
+            user_ids=np.empty(0, dtype=np.int64) if user_ids is None else user_ids,
+            assignments=self._assignments[:count]
+        )
+        os.replace(tmp_path, path)
+        self.modified = False
+
+    def load(self, path):
+        """Restore a saved index; returns False if there is nothing usable on disk"""
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                centroids = data['centroids'].astype(np.float32)
+                if self.n_lists and len(centroids) != self.n_lists:
+                    return False
+                self.centroids = centroids
+                self._trained_size = int(data['trained_size'])
+                self._saved_user_ids = data['user_ids']
+                self._saved_assignments = data['assignments'].astype(np.int32)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Ignoring unreadable face index {path}: {e}")
+            return False
+        return True
+
+
+INDEX_TYPES = {
+    BruteForceIndex.kind: BruteForceIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+
+def create_index(kind='brute', **options):
+    """Build a face index by name ('brute' or 'ivf')"""
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown face index '{kind}'")
+    if kind == BruteForceIndex.kind:
+        return BruteForceIndex()
+    return INDEX_TYPES[kind](**options)
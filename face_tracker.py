@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# A recognized face from a recent frame of one client
+Track = namedtuple('Track', ['location', 'fingerprint', 'match', 'expires'])
+
+
+class FaceTracker:
+    """Short-lived face tracks per kiosk session.
+
+    A kiosk sends a frame every few seconds, and someone standing in front
+    of it keeps the same box and appearance. Recognized faces are remembered
+    for ``ttl`` seconds so later frames can reuse the identity instead of
+    encoding the face again. A track is not extended when it is reused, so
+    every identity is confirmed with a fresh encoding at least once per ttl.
+    """
+
+    def __init__(self, ttl=6.0, iou_threshold=0.5, max_hash_distance=10, max_clients=1024):
+        self.ttl = ttl
+        self.iou_threshold = iou_threshold
+        self.max_hash_distance = max_hash_distance
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._tracks = OrderedDict()
+        self.frames = 0
+        self.frames_skipped = 0
+        self.faces = 0
+        self.faces_reused = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def tracks_for(self, client_id, gallery=None, now=None):
+        """Live tracks of a client, leaving out users no longer in the gallery"""
+        if not self.enabled or client_id is None:
+            return []
+        now = now or time.monotonic()
+        with self._lock:
+            tracks = self._tracks.get(client_id, [])
+        return [
+            track for track in tracks
+            if track.expires > now and (gallery is None or track.match.user_id in gallery)
+        ]
+
+    def update(self, client_id, faces, now=None):
+        """Replace a client's tracks with the recognized faces of its latest frame"""
+        now = now or time.monotonic()
+        previous = {track.match.user_id: track for track in self.tracks_for(client_id, now=now)}
+        tracks = []
+        for face in faces:
+            if face.match is None:
+                continue
+            expires = now + self.ttl
+            if face.reused and face.match.user_id in previous:
+                expires = previous[face.match.user_id].expires
+            tracks.append(Track(face.location, face.fingerprint, face.match, expires))
+
+        with self._lock:
+            self.frames += 1
+            self.faces += len(faces)
+            self.faces_reused += sum(1 for face in faces if face.reused)
+            if faces and all(face.reused for face in faces):
+                self.frames_skipped += 1
+
+            if client_id is None or not self.enabled:
+                return
+            self._tracks[client_id] = tracks
+            self._tracks.move_to_end(client_id)
+            while len(self._tracks) > self.max_clients:
+                self._tracks.popitem(last=False)
+
+    def stats(self):
+        """Counters plus the fraction of frames that skipped encoding entirely"""
+        with self._lock:
+            return {
+                'frames': self.frames,
+                'frames_skipped': self.frames_skipped,
+                'skip_fraction': self.frames_skipped / self.frames if self.frames else 0.0,
+                'faces': self.faces,
+                'faces_reused': self.faces_reused,
+                'clients': len(self._tracks)
+            }
@@ -1,77 +1,339 @@
-import face_recognition
+import math
+import struct
+import threading
+from collections import namedtuple
 import numpy as np
 import cv2
+from metrics import metrics
 
-def get_face_encoding(frame):
-    """Extract face encoding from a frame"""
-    # Convert BGR to RGB (face_recognition uses RGB)
-    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+# Tuning for the shared detection + encoding stage
+#   max_pixels: downscale frames to about this many pixels before detection (None keeps full size)
+#   upsample:   times dlib upsamples the image when looking for faces (finds smaller faces, slower)
+#   model:      face detector, 'hog' (CPU) or 'cnn'
+#   landmarks:  landmark model used for encoding, 'small' (5 points) or 'large' (68 points)
+#   rgb_input:  decode uploads straight to RGB, skipping the BGR->RGB conversion copy
+DetectionSettings = namedtuple('DetectionSettings', ['max_pixels', 'upsample', 'model', 'landmarks', 'rgb_input'])
+
+DEFAULT_DETECTION = DetectionSettings(
+    max_pixels=160 * 120,
+    upsample=1,
+    model='hog',
+    landmarks='small',
+    rgb_input=False
+)
+
+# Limits for uploaded images, applied before and while decoding
+#   max_bytes:      reject larger payloads without decoding them
+#   max_pixels:     reject images whose header declares more pixels than this
+#   reduced_decode: let libjpeg decode large JPEGs at 1/2, 1/4 or 1/8 size when the
+#                   result still covers the detection budget
+#   roi_margin:     grow a client-provided face region by this fraction on every side
+IngestSettings = namedtuple('IngestSettings', ['max_bytes', 'max_pixels', 'reduced_decode', 'roi_margin'])
+
+DEFAULT_INGEST = IngestSettings(
+    max_bytes=4 * 1024 * 1024,
+    max_pixels=4096 * 4096,
+    reduced_decode=True,
+    roi_margin=0.25
+)
+
+# Where a decoded frame sits in the uploaded image: original = frame / scale + (top, left)
+FrameOrigin = namedtuple('FrameOrigin', ['scale', 'top', 'left'])
+
+NO_CROP = FrameOrigin(1.0, 0, 0)
+
+# cv2.imread flags for JPEG decoding at a reduced size
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+class ImageTooLarge(ValueError):
+    """Raised for uploads over the configured byte or pixel limits"""
+
+
+# A face found in a frame, with its location in full-frame coordinates
+DetectedFace = namedtuple('DetectedFace', ['location', 'encoding'])
+
+# A face recognized with tracking; reused is True when the match came from a previous frame
+# (encoding is None then, since the face was not encoded again)
+TrackedFace = namedtuple('TrackedFace', ['location', 'fingerprint', 'match', 'reused', 'encoding'])
+
+
+_face_recognition = None
+_models_lock = threading.Lock()
+
+
+def load_models():
+    """Import face_recognition, which loads the dlib models, on first use"""
+    global _face_recognition
+    if _face_recognition is None:
+        with _models_lock:
+            if _face_recognition is None:
+                import face_recognition
+                _face_recognition = face_recognition
+    return _face_recognition
+
+
+def detection_scale(height, width, max_pixels):
+    """Resize factor that brings a frame within the pixel budget (never upscales)"""
+    if not max_pixels or height * width <= max_pixels:
+        return 1.0
+    return math.sqrt(max_pixels / float(height * width))
+
+
+def detect_faces(frame, settings=DEFAULT_DETECTION):
+    """Find faces in a frame.
+
+    Returns (small_frame, face_locations, scale): the resized RGB frame the
+    detector ran on, the locations in that frame, and the resize factor.
+    """
+    height, width = frame.shape[:2]
+    scale = detection_scale(height, width, settings.max_pixels)
     
-    # Resize image to 1/4 size for faster face detection
-    small_frame = cv2.resize(rgb_frame, (0, 0), fx=0.25, fy=0.25)
+    # Resize before converting so the color conversion only copies the small frame
+    with metrics.timer('resize'):
+        small_frame = frame
+        if scale < 1.0:
+            small_frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        # face_recognition uses RGB, OpenCV decodes to BGR unless asked for RGB
+        if not settings.rgb_input:
+            small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
     
     # Find face locations
-    face_locations = face_recognition.face_locations(small_frame)
+    with metrics.timer('detect'):
+        face_locations = load_models().face_locations(
+            small_frame, number_of_times_to_upsample=settings.upsample, model=settings.model)
+    
+    return small_frame, face_locations, scale
+
+def scale_location(location, scale, origin=NO_CROP):
+    """Scale a (top, right, bottom, left) box from the small frame back to the uploaded image"""
+    scale *= origin.scale
+    top, right, bottom, left = (int(round(coordinate / scale)) for coordinate in location)
+    return (top + origin.top, right + origin.left, bottom + origin.top, left + origin.left)
+
+def analyze_frame(frame, settings=DEFAULT_DETECTION, origin=NO_CROP):
+    """Detect and encode every face in a frame in a single pass"""
+    small_frame, face_locations, scale = detect_faces(frame, settings)
     
     if not face_locations:
-        return None
+        return []
     
     # Get face encodings
-    face_encodings = face_recognition.face_encodings(small_frame, face_locations)
+    with metrics.timer('encode'):
+        face_encodings = load_models().face_encodings(
+            small_frame, face_locations, model=settings.landmarks)
     
-    if not face_encodings:
-        return None
+    # Scale face locations back up to the original frame
+    return [
+        DetectedFace(location=scale_location(location, scale, origin), encoding=encoding)
+        for location, encoding in zip(face_locations, face_encodings)
+    ]
+
+def face_fingerprint(small_frame, location):
+    """64-bit average hash of a downsampled grayscale face crop"""
+    top, right, bottom, left = location
+    crop = small_frame[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)]
+    if crop.size == 0:
+        return 0
+    gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    tiny = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(tiny > tiny.mean())
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def box_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top = max(a[0], b[0])
+    right = min(a[1], b[1])
+    bottom = min(a[2], b[2])
+    left = max(a[3], b[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    if not intersection:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+def recognize_tracked(frame, gallery, tracks, tolerance=0.6, settings=DEFAULT_DETECTION,
+                      iou_threshold=0.5, max_hash_distance=10, origin=NO_CROP):
+    """Recognize faces, reusing identities from recent tracks instead of re-encoding.
+
+    A detected face that overlaps a live track (box IoU) and looks the same
+    (crop fingerprint) keeps that track's match; only the remaining faces are
+    encoded and matched against the gallery.
+    Returns a list of TrackedFace, one per detected face.
+    """
+    small_frame, face_locations, scale = detect_faces(frame, settings)
     
-    # Scale back up face locations
-    face_locations = [(top * 4, right * 4, bottom * 4, left * 4) 
-                      for (top, right, bottom, left) in face_locations]
+    faces = []
+    to_encode = []
+    for location in face_locations:
+        full_location = scale_location(location, scale, origin)
+        fingerprint = face_fingerprint(small_frame, location)
+        reused = None
+        for track in tracks:
+            if (box_iou(full_location, track.location) >= iou_threshold
+                    and bin(fingerprint ^ track.fingerprint).count('1') <= max_hash_distance):
+                reused = track.match
+                break
+        faces.append(TrackedFace(location=full_location, fingerprint=fingerprint, match=reused, reused=reused is not None,
+                                 encoding=None))
+        if reused is None:
+            to_encode.append(len(faces) - 1)
     
-    # Return the first face encoding and location
-    return face_encodings[0], face_locations[0]
+    # The expensive encoding only runs for new or unstable tracks
+    if to_encode and len(gallery):
+        with metrics.timer('encode'):
+            face_encodings = load_models().face_encodings(
+                small_frame, [face_locations[i] for i in to_encode], model=settings.landmarks)
+        with metrics.timer('match'):
+            matches = gallery.match(face_encodings, tolerance=tolerance)
+        for i, match, encoding in zip(to_encode, matches, face_encodings):
+            faces[i] = faces[i]._replace(match=match, encoding=encoding)
+    
+    return faces
 
-def recognize_face(frame, users):
-    """Recognize faces in the frame against registered users"""
-    if not users:
-        return None, None
-        
-    # Convert BGR to RGB
-    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+def decode_image(image_data, flags=cv2.IMREAD_COLOR, rgb=False):
+    """Decode uploaded image bytes into a BGR frame, or an RGB one with ``rgb``"""
+    if rgb:
+        flags = flags & ~cv2.IMREAD_COLOR | cv2.IMREAD_COLOR_RGB
+    with metrics.timer('decode'):
+        nparr = np.frombuffer(image_data, np.uint8)
+        frame = cv2.imdecode(nparr, flags)
+    if frame is None:
+        raise ValueError('Could not decode image')
+    return frame
+
+def image_dimensions(image_data):
+    """(width, height) read from a JPEG or PNG header without decoding, or None"""
+    data = memoryview(image_data)
+    if bytes(data[:8]) == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if bytes(data[:2]) != b'\xff\xd8':
+        return None
+    # Walk the JPEG segments up to the start-of-frame marker
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+def _region(roi, width, height, margin):
+    """Clamp a (top, right, bottom, left) region grown by margin to the image, or None if empty"""
+    top, right, bottom, left = roi
+    grow_y = (bottom - top) * margin
+    grow_x = (right - left) * margin
+    top = max(0, int(top - grow_y))
+    left = max(0, int(left - grow_x))
+    bottom = min(height, int(bottom + grow_y))
+    right = min(width, int(right + grow_x))
+    if bottom <= top or right <= left:
+        return None
+    return top, right, bottom, left
+
+def check_image_size(image_data, settings=DEFAULT_INGEST):
+    """Raise ImageTooLarge for payloads over the byte limit, before any decoding"""
+    if settings.max_bytes and len(image_data) > settings.max_bytes:
+        raise ImageTooLarge(f'Image is larger than {settings.max_bytes} bytes')
+
+def ingest_image(image_data, settings=DEFAULT_INGEST, detection=DEFAULT_DETECTION, roi=None):
+    """Check and decode an uploaded image for recognition.
+
+    Oversized payloads raise ImageTooLarge. Large JPEGs are decoded at a
+    reduced size that still covers the detection budget. The whole image is
+    decoded either way; a (top, right, bottom, left) face ``roi`` then crops
+    the decoded frame, so only that region reaches detection.
+    Returns (frame, origin) where origin maps frame coordinates back to
+    the uploaded image.
+    """
+    check_image_size(image_data, settings)
     
-    # Resize image to 1/4 size for faster face detection
-    small_frame = cv2.resize(rgb_frame, (0, 0), fx=0.25, fy=0.25)
+    dimensions = image_dimensions(image_data)
+    if dimensions is None:
+        return decode_image(image_data, rgb=detection.rgb_input), NO_CROP
+    width, height = dimensions
+    if settings.max_pixels and width * height > settings.max_pixels:
+        raise ImageTooLarge(f'Image is larger than {settings.max_pixels} pixels')
     
-    # Find face locations
-    face_locations = face_recognition.face_locations(small_frame)
+    # Decode at the smallest size that detection would not downscale the full frame below anyway.
+    # A region is cropped from that, so faces in it keep at least the full-frame detection resolution
+    flags = cv2.IMREAD_COLOR
+    if settings.reduced_decode and detection.max_pixels and bytes(image_data[:2]) == b'\xff\xd8':
+        for factor, reduced_flags in REDUCED_DECODE_FLAGS:
+            if width * height / (factor * factor) >= detection.max_pixels:
+                flags = reduced_flags
+                break
+    frame = decode_image(image_data, flags, detection.rgb_input)
+    # Longest sides, since EXIF orientation may have rotated the decoded frame
+    scale = max(frame.shape[:2]) / float(max(width, height))
     
-    if not face_locations:
+    region = _region(roi, width, height, settings.roi_margin) if roi else None
+    if region is None:
+        return frame, FrameOrigin(scale, 0, 0)
+    top, right, bottom, left = (int(round(coordinate * scale)) for coordinate in region)
+    frame = frame[top:bottom, left:right]
+    return frame, FrameOrigin(scale, int(round(top / scale)), int(round(left / scale)))
+
+def get_face_encoding(frame, settings=DEFAULT_DETECTION):
+    """Extract face encoding from a frame"""
+    faces = analyze_frame(frame, settings)
+    
+    if not faces:
+        return None
+    
+    # Return the first face encoding and location
+    return faces[0].encoding, faces[0].location
+
+def recognize_face(frame, gallery, tolerance=0.6, settings=DEFAULT_DETECTION):
+    """Recognize faces in the frame against the enrolled face gallery"""
+    if not len(gallery):
         return None, None
     
-    # Get face encodings
-    face_encodings = face_recognition.face_encodings(small_frame, face_locations)
+    faces = analyze_frame(frame, settings)
     
-    if not face_encodings:
+    if not faces:
         return None, None
     
-    # Scale back up face locations
-    face_locations = [(top * 4, right * 4, bottom * 4, left * 4) 
-                      for (top, right, bottom, left) in face_locations]
+    # Match every face in the frame with one vectorized distance computation
+    with metrics.timer('match'):
+        matches = gallery.match([face.encoding for face in faces], tolerance=tolerance)
     
-    # Check each face in the frame
-    for face_encoding, face_location in zip(face_encodings, face_locations):
-        # Compare with known faces
-        known_encodings = [user.get_face_encoding() for user in users]
-        
-        # Compare faces
-        matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
-        face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-        
-        if True in matches:
-            best_match_index = np.argmin(face_distances)
-            if matches[best_match_index]:
-                return users[best_match_index], face_location
+    for match, face in zip(matches, faces):
+        if match:
+            return match, face.location
     
     return None, None
 
+def recognize_faces_batch(frames, gallery, tolerance=0.6, settings=DEFAULT_DETECTION, origins=None):
+    """Recognize every face in a batch of frames.
+
+    Frames that are None (failed to decode) yield no faces. Encodings from the
+    whole batch are matched against the gallery in one matrix operation.
+    Returns one list of (match, face_location) pairs per frame, unmatched faces
+    included with a match of None.
+    """
+    origins = origins or [NO_CROP] * len(frames)
+    faces_per_frame = [
+        analyze_frame(frame, settings, origin) if frame is not None else []
+        for frame, origin in zip(frames, origins)
+    ]
+    
+    encodings = [face.encoding for faces in faces_per_frame for face in faces]
+    with metrics.timer('match'):
+        matches = iter(gallery.match(encodings, tolerance=tolerance) if encodings and len(gallery) else [None] * len(encodings))
+    
+    return [[(next(matches), face.location) for face in faces] for faces in faces_per_frame]
+
 def draw_face_box(frame, location, name=None):
     """Draw a box around the face and display name"""
     top, right, bottom, left = location
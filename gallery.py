@@ -0,0 +1,414 @@
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import encoding_format
+from face_index import BruteForceIndex
+
+# Size of a dlib face encoding
+ENCODING_SIZE = 128
+
+# Rows allocated up front; the buffers double whenever they run out
+INITIAL_CAPACITY = 64
+
+# Plain record returned for a recognized face (no live database objects)
+GalleryMatch = namedtuple('GalleryMatch', ['user_id', 'name', 'email', 'distance'])
+
+# Copy of the gallery contents at a single version
+GallerySnapshot = namedtuple('GallerySnapshot', ['version', 'encodings', 'sq_norms', 'user_ids', 'names', 'emails', 'templates'])
+
+
+class FaceGallery:
+    """Contiguous float32 matrix of enrolled face encodings for vectorized matching.
+
+    Writers patch the buffers in place under a lock and bump ``version`` to an
+    odd value while they work and back to an even value when done. Readers
+    retry if the version was odd or changed during their computation, so a
+    recognition always sees one consistent state of the gallery.
+
+    A user enrolled with several templates is stored as the centroid of them
+    plus the radius of the farthest template. Since no template can be closer
+    than the centroid distance minus the radius, matching visits users in
+    order of that bound and stops once the bound exceeds the tolerance or the
+    best template distance found so far, which gives the exact closest user.
+    Template arrays are never modified in place, only replaced, so readers
+    can use them without copying.
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY, index=None):
+        self._lock = threading.Lock()
+        self._index = index or BruteForceIndex()
+        self._version = 0
+        self._count = 0
+        self._encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+        self._sq_norms = np.empty(capacity, dtype=np.float32)
+        self._user_ids = np.empty(capacity, dtype=np.int64)
+        self._radii = np.zeros(capacity, dtype=np.float32)
+        self._names = []
+        self._emails = []
+        self._rows = {}
+        # user_id -> (K, 128) templates, only for users with more than one
+        self._templates = {}
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def capacity(self):
+        return len(self._user_ids)
+
+    @property
+    def index(self):
+        return self._index
+
+    def set_index(self, index):
+        """Swap the search index, rebuilding it over the current rows"""
+        with self._writing():
+            self._index = index
+            index.reset(self._encodings[:self._count], self._user_ids[:self._count])
+
+    def save_index(self, path):
+        """Persist the search index together with the row order it was built for"""
+        def save(count, encodings, sq_norms, user_ids, names, emails):
+            self._index.save(path, user_ids.copy())
+            return True
+        self._read(save)
+
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            self._version += 1
+            try:
+                yield
+            finally:
+                self._version += 1
+
+    def _read(self, func):
+        """Run func(count, encodings, sq_norms, user_ids, names, emails) on a consistent view"""
+        while True:
+            version = self._version
+            if version % 2:
+                time.sleep(0)
+                continue
+            count = self._count
+            try:
+                result = func(count, self._encodings[:count], self._sq_norms[:count],
+                              self._user_ids[:count], self._names, self._emails)
+            except IndexError:
+                # Metadata shrank under us; the version check below forces a retry
+                result = None
+            if self._version == version:
+                return result
+
+    def snapshot(self):
+        """Return a copy of the gallery contents at a single version"""
+        def copy(count, encodings, sq_norms, user_ids, names, emails):
+            return GallerySnapshot(
+                version=self._version,
+                encodings=encodings.copy(),
+                sq_norms=sq_norms.copy(),
+                user_ids=user_ids.copy(),
+                names=list(names[:count]),
+                emails=list(emails[:count]),
+                templates=dict(self._templates)
+            )
+        return self._read(copy)
+
+    def load_rows(self, rows, template_rows=()):
+        """Rebuild the gallery from (user_id, name, email, encoding blob) rows.
+
+        ``template_rows`` are (user_id, encoding blob) pairs of extra templates
+        stored alongside each user's enrollment encoding.
+        """
+        rows = list(rows)
+        count = len(rows)
+        capacity = max(INITIAL_CAPACITY, count)
+        encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+        user_ids = np.empty(capacity, dtype=np.int64)
+        names = []
+        emails = []
+
+        # Decode every blob straight into its row of the preallocated buffer
+        for row, (user_id, name, email, blob) in enumerate(rows):
+            encoding_format.unpack_into(blob, encodings[row])
+            user_ids[row] = user_id
+            names.append(name)
+            emails.append(email)
+
+        extra = {}
+        for user_id, blob in template_rows:
+            extra.setdefault(user_id, []).append(encoding_format.unpack(blob))
+        templates = {}
+        for row in range(count):
+            user_id = int(user_ids[row])
+            if user_id in extra:
+                templates[user_id] = np.vstack([encodings[row]] + extra[user_id]).astype(np.float32)
+                encodings[row] = templates[user_id].mean(axis=0)
+
+        self._install(count, encodings, user_ids, names, emails, templates)
+
+    def load_snapshot(self, snapshot, copy=True):
+        """Rebuild the gallery from a GallerySnapshot taken from another gallery.
+
+        With ``copy`` False the snapshot arrays (e.g. copy-on-write memory maps)
+        become the gallery buffers until the first new row forces them to grow.
+        """
+        count = len(snapshot.user_ids)
+        if copy:
+            capacity = max(INITIAL_CAPACITY, count)
+            encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+            user_ids = np.empty(capacity, dtype=np.int64)
+            encodings[:count] = snapshot.encodings
+            user_ids[:count] = snapshot.user_ids
+        else:
+            encodings = snapshot.encodings
+            user_ids = snapshot.user_ids
+        self._install(count, encodings, user_ids, list(snapshot.names), list(snapshot.emails),
+                      dict(snapshot.templates))
+
+    def _install(self, count, encodings, user_ids, names, emails, templates=None):
+        """Swap in freshly built buffers whose first count rows are filled"""
+        sq_norms = np.empty(len(user_ids), dtype=np.float32)
+        sq_norms[:count] = np.einsum('ij,ij->i', encodings[:count], encodings[:count])
+        templates = templates or {}
+        radii = np.zeros(len(user_ids), dtype=np.float32)
+        for row in range(count):
+            user_templates = templates.get(int(user_ids[row]))
+            if user_templates is not None:
+                radii[row] = template_radius(user_templates, encodings[row])
+
+        with self._writing():
+            self._count = count
+            self._encodings = encodings
+            self._sq_norms = sq_norms
+            self._user_ids = user_ids
+            self._radii = radii
+            self._names = names
+            self._emails = emails
+            self._templates = templates
+            self._rows = {int(user_id): row for row, user_id in enumerate(user_ids[:count])}
+            self._index.reset(encodings[:count], user_ids[:count])
+
+    def _grow(self):
+        """Double the capacity of the row buffers"""
+        capacity = max(INITIAL_CAPACITY, self.capacity * 2)
+        encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        user_ids = np.empty(capacity, dtype=np.int64)
+        radii = np.zeros(capacity, dtype=np.float32)
+        encodings[:self._count] = self._encodings[:self._count]
+        sq_norms[:self._count] = self._sq_norms[:self._count]
+        user_ids[:self._count] = self._user_ids[:self._count]
+        radii[:self._count] = self._radii[:self._count]
+        self._encodings = encodings
+        self._sq_norms = sq_norms
+        self._user_ids = user_ids
+        self._radii = radii
+
+    def add(self, user_id, name, email, encoding):
+        """Add a user to the gallery, replacing their encoding if already present"""
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        with self._writing():
+            row = self._rows.get(user_id)
+            if row is None:
+                if self._count == self.capacity:
+                    self._grow()
+                row = self._count
+                self._names.append(name)
+                self._emails.append(email)
+            else:
+                self._names[row] = name
+                self._emails[row] = email
+            self._encodings[row] = encoding
+            self._sq_norms[row] = encoding @ encoding
+            self._user_ids[row] = user_id
+            self._radii[row] = 0.0
+            self._templates.pop(user_id, None)
+            self._index.add(row, encoding)
+            if user_id not in self._rows:
+                self._rows[user_id] = row
+                self._count += 1
+
+    def remove(self, user_id):
+        """Remove a user by moving the last row into their slot"""
+        with self._writing():
+            row = self._rows.pop(user_id, None)
+            if row is None:
+                return False
+            last = self._count - 1
+            self._templates.pop(user_id, None)
+            self._index.remove(row, last)
+            if row != last:
+                moved_id = int(self._user_ids[last])
+                self._encodings[row] = self._encodings[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._user_ids[row] = moved_id
+                self._radii[row] = self._radii[last]
+                self._names[row] = self._names[last]
+                self._emails[row] = self._emails[last]
+                self._rows[moved_id] = row
+            self._count = last
+            self._names.pop()
+            self._emails.pop()
+            return True
+
+    def set_templates(self, user_id, encodings):
+        """Replace a user's templates and match them by their centroid first"""
+        templates = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        centroid = templates.mean(axis=0)
+        with self._writing():
+            row = self._rows.get(user_id)
+            if row is None:
+                return False
+            if len(templates) > 1:
+                self._templates[user_id] = templates
+            else:
+                self._templates.pop(user_id, None)
+            self._radii[row] = template_radius(templates, centroid)
+            self._encodings[row] = centroid
+            self._sq_norms[row] = centroid @ centroid
+            self._index.add(row, centroid)
+            return True
+
+    def templates(self, user_id):
+        """A user's templates as a (K, 128) array, or None if not enrolled"""
+        def get(count, encodings, sq_norms, user_ids, names, emails):
+            row = self._rows.get(user_id)
+            if row is None:
+                return None
+            templates = self._templates.get(user_id)
+            return templates if templates is not None else encodings[row:row + 1].copy()
+        return self._read(get)
+
+    def template_distance(self, user_id, encoding):
+        """Distance from an encoding to the nearest template of a user (None if unknown)"""
+        templates = self.templates(user_id)
+        if templates is None:
+            return None
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        return float(np.min(np.linalg.norm(templates - encoding, axis=1)))
+
+    def update_metadata(self, user_id, name, email):
+        """Change the name and email shown for a user without touching face data"""
+        with self._writing():
+            row = self._rows.get(user_id)
+            if row is None:
+                return False
+            self._names[row] = name
+            self._emails[row] = email
+            return True
+
+    def match(self, face_encodings, tolerance=0.6):
+        """Match a batch of encodings against the gallery.
+
+        Returns one GalleryMatch (or None) per input encoding.
+        """
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+        def best_matches(count, encodings, sq_norms, user_ids, names, emails):
+            if count == 0 or len(queries) == 0:
+                return [None] * len(queries)
+
+            # Re-rank the index candidates (or every row) with exact distances
+            candidate_rows = self._index.candidates(queries, count)
+            if candidate_rows is not None:
+                if len(candidate_rows) == 0:
+                    return [None] * len(queries)
+                encodings = np.take(encodings, candidate_rows, axis=0)
+                sq_norms = np.take(sq_norms, candidate_rows)
+
+            distances = squared_distances(queries, encodings, sq_norms)
+            templates = self._templates
+            if templates:
+                radii = self._radii[:count]
+                if candidate_rows is not None:
+                    radii = np.take(radii, candidate_rows)
+                best_rows, best_distances = refine(distances, radii, user_ids, candidate_rows, templates)
+            else:
+                best_rows = np.argmin(distances, axis=1)
+                best_distances = np.sqrt(distances[np.arange(len(queries)), best_rows])
+                if candidate_rows is not None:
+                    best_rows = candidate_rows[best_rows]
+
+            results = []
+            for row, distance in zip(best_rows, best_distances):
+                if distance <= tolerance:
+                    results.append(GalleryMatch(
+                        user_id=int(user_ids[row]),
+                        name=names[row],
+                        email=emails[row],
+                        distance=float(distance)
+                    ))
+                else:
+                    results.append(None)
+            return results
+
+        def refine(distances, radii, user_ids, candidate_rows, templates):
+            # Branch and bound: visit users within tolerance by the lower bound on their
+            # template distance and stop once no remaining user can beat the best so far
+            bounds = np.sqrt(distances) - radii[None, :]
+
+            best_rows = np.zeros(len(queries), dtype=np.int64)
+            best_distances = np.full(len(queries), np.inf, dtype=np.float32)
+            for i, query in enumerate(queries):
+                within = np.flatnonzero(bounds[i] <= tolerance)
+                for column in within[np.argsort(bounds[i, within], kind='stable')]:
+                    if bounds[i, column] >= best_distances[i]:
+                        break
+                    row = column if candidate_rows is None else candidate_rows[column]
+                    user_templates = templates.get(int(user_ids[row]))
+                    if user_templates is None:
+                        distance = np.sqrt(distances[i, column])
+                    else:
+                        distance = np.min(np.linalg.norm(user_templates - query, axis=1))
+                    if distance < best_distances[i]:
+                        best_rows[i] = row
+                        best_distances[i] = distance
+            return best_rows, best_distances
+
+        return self._read(best_matches)
+
+
+def template_radius(templates, centroid):
+    """Distance from a centroid to the farthest of its templates"""
+    if len(templates) < 2:
+        return 0.0
+    return float(np.max(np.linalg.norm(templates - centroid, axis=1)))
+
+
+def redundant_templates(encodings, count, keep=0):
+    """Indices of the count templates that add the least variety to a set.
+
+    Repeatedly drops the template closest to any other one; the first ``keep``
+    templates are never dropped and ties go to the oldest (lowest index).
+    """
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    distances = np.sqrt(squared_distances(encodings, encodings, np.einsum('ij,ij->i', encodings, encodings)))
+    np.fill_diagonal(distances, np.inf)
+    remaining = list(range(len(encodings)))
+    dropped = []
+    while len(dropped) < count:
+        nearest = distances[np.ix_(remaining, remaining)].min(axis=1)
+        candidates = [position for position, index in enumerate(remaining) if index >= keep]
+        if not candidates:
+            break
+        position = min(candidates, key=lambda position: nearest[position])
+        dropped.append(remaining.pop(position))
+    return dropped
+
+
+def squared_distances(queries, encodings, sq_norms):
+    """Squared euclidean distances between every query and every gallery row"""
+    query_sq_norms = np.einsum('ij,ij->i', queries, queries)
+    distances = query_sq_norms[:, None] + sq_norms[None, :] - 2.0 * (queries @ encodings.T)
+    # Rounding can push identical vectors slightly below zero
+    np.maximum(distances, 0.0, out=distances)
+    return distances
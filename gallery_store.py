@@ -0,0 +1,93 @@
+import json
+import os
+import shutil
+import numpy as np
+from gallery import GallerySnapshot, ENCODING_SIZE
+
+# Bump when the files written by save change meaning
+FORMAT_VERSION = 1
+
+MANIFEST = 'manifest.json'
+
+
+def save(directory, snapshot, stamp):
+    """Write a gallery snapshot as .npy files plus a manifest holding the database stamp.
+
+    The snapshot is built in a sibling directory and swapped in, so readers
+    see either the old snapshot, the new one, or none.
+    """
+    building = directory + '.tmp'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+
+    owners = sorted(snapshot.templates)
+    templates = [snapshot.templates[user_id] for user_id in owners]
+    np.save(os.path.join(building, 'encodings.npy'), np.ascontiguousarray(snapshot.encodings, dtype=np.float32))
+    np.save(os.path.join(building, 'user_ids.npy'), np.asarray(snapshot.user_ids, dtype=np.int64))
+    np.save(os.path.join(building, 'templates.npy'),
+            np.vstack(templates).astype(np.float32) if templates else np.empty((0, ENCODING_SIZE), dtype=np.float32))
+    np.save(os.path.join(building, 'template_counts.npy'), np.array([len(t) for t in templates], dtype=np.int64))
+
+    with open(os.path.join(building, MANIFEST), 'w') as f:
+        json.dump({
+            'format': FORMAT_VERSION,
+            'stamp': stamp,
+            'count': len(snapshot.user_ids),
+            'template_owners': owners,
+            'names': list(snapshot.names),
+            'emails': list(snapshot.emails)
+        }, f)
+
+    previous = directory + '.old'
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, previous)
+    os.rename(building, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def load(directory, stamp=None, mmap=True):
+    """Open a saved snapshot, or return None if it is missing or was saved for another stamp.
+
+    With ``mmap`` the encodings are mapped copy-on-write, so processes that
+    load the same snapshot share its pages until they modify a row.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Error reading gallery snapshot: {e}")
+        return None
+    if manifest.get('format') != FORMAT_VERSION or (stamp is not None and manifest.get('stamp') != stamp):
+        return None
+
+    mode = 'c' if mmap else None
+    try:
+        encodings = np.load(os.path.join(directory, 'encodings.npy'), mmap_mode=mode)
+        user_ids = np.load(os.path.join(directory, 'user_ids.npy'), mmap_mode=mode)
+        templates = np.load(os.path.join(directory, 'template_counts.npy'))
+        stacked = np.load(os.path.join(directory, 'templates.npy'))
+    except (OSError, ValueError) as e:
+        print(f"Error reading gallery snapshot: {e}")
+        return None
+
+    count = manifest['count']
+    if encodings.shape != (count, ENCODING_SIZE) or len(user_ids) != count:
+        print("Gallery snapshot is inconsistent, ignoring it")
+        return None
+
+    offsets = np.concatenate([[0], np.cumsum(templates)])
+    return GallerySnapshot(
+        version=0,
+        encodings=encodings,
+        sq_norms=None,
+        user_ids=user_ids,
+        names=manifest['names'],
+        emails=manifest['emails'],
+        templates={
+            user_id: stacked[offsets[i]:offsets[i + 1]]
+            for i, user_id in enumerate(manifest['template_owners'])
+        }
+    )
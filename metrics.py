@@ -0,0 +1,257 @@
+import bisect
+import cProfile
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Quantiles reported over the rolling window
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Counters exported even before they are first incremented
+COUNTERS = {
+    'frames': 'Frames received for recognition',
+    'image_bytes': 'Bytes of uploaded images received for recognition',
+    'rejected': 'Uploaded images rejected for exceeding the size limits',
+    'faces': 'Faces found in frames',
+    'matches': 'Faces matched to an enrolled user',
+    'cooldown_hits': 'Recognitions skipped because the user was on cooldown',
+    'attendance_recorded': 'Attendance records created',
+    'busy': 'Requests rejected because every recognition worker was busy',
+    'errors': 'Errors while recognizing faces or writing attendance'
+}
+
+
+class _NullTimer:
+    """Timer handed out while metrics are disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class RollingHistogram:
+    """Cumulative latency histogram plus bucket counts over the last ``window`` seconds.
+
+    The cumulative buckets are exported as a Prometheus histogram. The rolling
+    counts are kept in ``slots`` sub-windows so quantiles reflect recent
+    requests only.
+    """
+
+    def __init__(self, window=60.0, slots=6):
+        self.window = window
+        self.slot_length = window / slots
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self._slots = deque(maxlen=slots)
+
+    def observe(self, seconds, now):
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        self.counts[bucket] += 1
+        self.total += seconds
+        self.count += 1
+
+        slot_start = now - now % self.slot_length
+        if not self._slots or self._slots[-1][0] != slot_start:
+            self._slots.append((slot_start, [0] * len(BUCKETS)))
+        self._slots[-1][1][bucket] += 1
+
+    def recent_counts(self, now):
+        counts = [0] * len(BUCKETS)
+        for slot_start, slot_counts in self._slots:
+            if slot_start > now - self.window:
+                for bucket, count in enumerate(slot_counts):
+                    counts[bucket] += count
+        return counts
+
+    def quantile(self, q, now):
+        """Estimate a quantile of the rolling window by interpolating within its bucket"""
+        counts = self.recent_counts(now)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bucket, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[bucket - 1] if bucket else 0.0
+                upper = BUCKETS[bucket] if bucket < len(BUCKETS) - 1 else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-2]
+
+
+class Metrics:
+    """Stage timers and counters for the recognition path.
+
+    ``with metrics.timer('detect'):`` times a stage and ``metrics.count('faces')``
+    bumps a counter. Both return immediately while metrics are disabled.
+
+    Recognition workers run with ``buffered`` set: their observations are
+    collected with ``drain`` and sent back with each result, then recorded in
+    the web process with ``absorb``, which is the process ``render`` reports.
+    """
+
+    def __init__(self, enabled=False, window=60.0):
+        self.enabled = enabled
+        self.window = window
+        self._buffer = None
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = dict.fromkeys(COUNTERS, 0)
+
+    def configure(self, enabled, window=60.0, buffered=False):
+        self.enabled = enabled
+        self.window = window
+        self._buffer = [] if buffered else None
+
+    def timer(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Record how long one run of a stage took"""
+        if not self.enabled:
+            return
+        if self._buffer is not None:
+            self._buffer.append((stage, seconds))
+            return
+        now = time.monotonic()
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = RollingHistogram(self.window)
+            histogram.observe(seconds, now)
+
+    def count(self, name, value=1):
+        if not self.enabled or not value:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def drain(self):
+        """Take the observations buffered in a worker process"""
+        if not self._buffer:
+            return None
+        observations, self._buffer = self._buffer, []
+        return observations
+
+    def absorb(self, observations):
+        """Record observations drained from a worker process"""
+        for stage, seconds in observations or ():
+            self.observe(stage, seconds)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        now = time.monotonic()
+        lines = []
+        with self._lock:
+            for name, description in COUNTERS.items():
+                lines.append(f'# HELP smart_attendance_{name}_total {description}')
+                lines.append(f'# TYPE smart_attendance_{name}_total counter')
+                lines.append(f'smart_attendance_{name}_total {self._counters.get(name, 0)}')
+
+            histograms = sorted(self._histograms.items())
+            lines.append('# HELP smart_attendance_stage_seconds Time spent in each recognition stage')
+            lines.append('# TYPE smart_attendance_stage_seconds histogram')
+            for stage, histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'smart_attendance_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'smart_attendance_stage_seconds_sum{{stage="{stage}"}} {histogram.total:.6f}')
+                lines.append(f'smart_attendance_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            lines.append(f'# HELP smart_attendance_stage_recent_seconds '
+                         f'Stage time quantiles over the last {self.window:g} seconds')
+            lines.append('# TYPE smart_attendance_stage_recent_seconds gauge')
+            for stage, histogram in histograms:
+                for q in QUANTILES:
+                    value = histogram.quantile(q, now)
+                    if value is not None:
+                        lines.append(f'smart_attendance_stage_recent_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+class SampledProfiler:
+    """Profile a random fraction of recognitions with cProfile.
+
+    Each sampled call is dumped to ``directory`` as a .prof file readable with
+    pstats or snakeviz; only the newest ``max_files`` dumps are kept.
+    """
+
+    def __init__(self, rate=0.0, directory=None, max_files=50):
+        self.rate = rate
+        self.directory = directory
+        self.max_files = max_files
+        # cProfile cannot profile two calls on the same thread at once
+        self._busy = threading.Lock()
+
+    def configure(self, rate, directory, max_files=50):
+        self.rate = rate
+        self.directory = directory
+        self.max_files = max_files
+
+    @contextmanager
+    def sample(self, name):
+        if not self.rate or random.random() >= self.rate or not self._busy.acquire(blocking=False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            self._dump(profiler, name)
+        finally:
+            self._busy.release()
+
+    def _dump(self, profiler, name):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{name}-{time.time():.6f}-{os.getpid()}.prof')
+            profiler.dump_stats(path)
+            dumps = sorted(
+                (entry for entry in os.scandir(self.directory) if entry.name.endswith('.prof')),
+                key=lambda entry: entry.stat().st_mtime
+            )
+            for entry in dumps[:-self.max_files]:
+                os.remove(entry.path)
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+
+
+# Global instances shared by the web process (and set up again in each worker)
+metrics = Metrics()
+profiler = SampledProfiler()
@@ -1,7 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from datetime import datetime
-import numpy as np
-import pickle
+import itertools
+import encoding_format
+from gallery import redundant_templates
 
 db = SQLAlchemy()
 
@@ -13,18 +16,114 @@ class User(db.Model):
     face_encoding = db.Column(db.LargeBinary, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     attendances = db.relationship('Attendance', backref='user', lazy=True, cascade="all, delete-orphan")
+    face_templates = db.relationship('FaceTemplate', backref='user', lazy=True, cascade="all, delete-orphan",
+                                     order_by='FaceTemplate.id')
 
-    def set_face_encoding(self, encoding):
-        self.face_encoding = pickle.dumps(encoding)
+    def set_face_encoding(self, encoding, dtype='float32'):
+        self.face_encoding = encoding_format.pack(encoding, dtype)
     
     def get_face_encoding(self):
-        return pickle.loads(self.face_encoding)
+        return encoding_format.unpack(self.face_encoding)
+
+    def get_face_templates(self):
+        """The enrollment encoding followed by every learned template"""
+        return [self.get_face_encoding()] + [template.get_encoding() for template in self.face_templates]
+
+    def add_face_template(self, encoding, max_templates, dtype='float32'):
+        """Store a learned template, pruning the most redundant ones beyond max_templates.
+
+        The enrollment encoding counts towards the limit but is never pruned.
+        """
+        template = FaceTemplate()
+        template.set_encoding(encoding, dtype)
+        self.face_templates.append(template)
+        excess = len(self.face_templates) + 1 - max_templates
+        if excess > 0:
+            templates = list(self.face_templates)
+            for index in redundant_templates(self.get_face_templates(), excess, keep=1):
+                self.face_templates.remove(templates[index - 1])
+
+    @classmethod
+    def gallery_rows(cls):
+        """Load (id, name, email, face_encoding) for every user in a single query"""
+        return db.session.execute(
+            db.select(cls.id, cls.name, cls.email, cls.face_encoding).order_by(cls.id)
+        ).all()
+
+    @classmethod
+    def page(cls, after_id=None, limit=50):
+        """One page of users ordered by id, without the face encoding column.
+
+        Returns (rows, next_after_id); next_after_id is None on the last page.
+        """
+        query = db.select(cls.id, cls.name, cls.email, cls.custom_data, cls.created_at).order_by(cls.id)
+        if after_id is not None:
+            query = query.where(cls.id > after_id)
+        rows = db.session.execute(query.limit(limit + 1)).all()
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1].id
+        return rows, None
+
+    @classmethod
+    def migrate_face_encodings(cls, dtype='float32', batch_size=500):
+        """Rewrite legacy pickled encodings in the binary format, one batch per commit.
+
+        Returns the number of rows converted.
+        """
+        converted = 0
+        last_id = 0
+        while True:
+            batch = db.session.execute(
+                db.select(cls.id, cls.face_encoding)
+                .where(cls.id > last_id)
+                .order_by(cls.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                return converted
+
+            updates = [
+                {'id': user_id, 'face_encoding': encoding_format.pack(encoding_format.unpack(blob), dtype)}
+                for user_id, blob in batch
+                if encoding_format.is_legacy(blob)
+            ]
+            if updates:
+                db.session.execute(db.update(cls), updates)
+                GalleryState.bump()
+                db.session.commit()
+                converted += len(updates)
+            last_id = batch[-1][0]
+
+class FaceTemplate(db.Model):
+    """Extra face encoding of a user, learned from a confident recognition"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    encoding = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def set_encoding(self, encoding, dtype='float32'):
+        self.encoding = encoding_format.pack(encoding, dtype)
+
+    def get_encoding(self):
+        return encoding_format.unpack(self.encoding)
+
+    @classmethod
+    def gallery_rows(cls):
+        """Load (user_id, encoding) for every learned template in a single query"""
+        return db.session.execute(
+            db.select(cls.user_id, cls.encoding).order_by(cls.user_id, cls.id)
+        ).all()
 
 class Attendance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_attendance_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_attendance_timestamp', 'timestamp'),
+    )
+    
     @classmethod
     def get_recent_attendance(cls, user_id, seconds=300):
         """Check if user has attendance record in the last X seconds"""
@@ -34,3 +133,121 @@ class Attendance(db.Model):
             cls.timestamp > datetime.fromtimestamp(cutoff)
         ).first()
         return recent is not None
+
+    @classmethod
+    def last_seen_since(cls, cutoff):
+        """Latest attendance time per user for records newer than cutoff"""
+        rows = db.session.query(cls.user_id, db.func.max(cls.timestamp)).filter(
+            cls.timestamp > cutoff
+        ).group_by(cls.user_id)
+        return dict(rows.all())
+
+    @classmethod
+    def filtered(cls, query, start=None, end=None, user_id=None):
+        """Apply the admin date range [start, end) and user filters to a query"""
+        if start is not None:
+            query = query.where(cls.timestamp >= start)
+        if end is not None:
+            query = query.where(cls.timestamp < end)
+        if user_id is not None:
+            query = query.where(cls.user_id == user_id)
+        return query
+
+    @classmethod
+    def page(cls, before=None, limit=50, start=None, end=None, user_id=None):
+        """One page of attendance, newest first, with the user's name and email joined in.
+
+        ``before`` is the (timestamp, id) of the last row of the previous page.
+        Returns (records, next_before); next_before is None on the last page.
+        """
+        query = cls.filtered(
+            db.select(cls).options(
+                db.joinedload(cls.user).load_only(User.id, User.name, User.email)
+            ),
+            start, end, user_id
+        ).order_by(cls.timestamp.desc(), cls.id.desc())
+        if before is not None:
+            before_timestamp, before_id = before
+            query = query.where(db.or_(
+                cls.timestamp < before_timestamp,
+                db.and_(cls.timestamp == before_timestamp, cls.id < before_id)
+            ))
+        records = db.session.execute(query.limit(limit + 1)).scalars().all()
+        if len(records) > limit:
+            last = records[limit - 1]
+            return records[:limit], (last.timestamp, last.id)
+        return records, None
+
+    @classmethod
+    def daily_counts(cls, start=None, end=None, user_id=None, limit=31):
+        """Attendance count per day, most recent day first"""
+        day = db.func.date(cls.timestamp).label('day')
+        query = cls.filtered(
+            db.select(day, db.func.count(cls.id).label('count'), db.func.count(db.distinct(cls.user_id)).label('users')),
+            start, end, user_id
+        ).group_by(day).order_by(day.desc()).limit(limit)
+        return db.session.execute(query).all()
+
+    @classmethod
+    def user_counts(cls, start=None, end=None, user_id=None, limit=20):
+        """Attendance count and last check-in per user, most frequent first"""
+        count = db.func.count(cls.id).label('count')
+        query = cls.filtered(
+            db.select(User.id, User.name, User.email, count, db.func.max(cls.timestamp).label('last_seen'))
+            .join(User, User.id == cls.user_id),
+            start, end, user_id
+        ).group_by(User.id, User.name, User.email).order_by(count.desc()).limit(limit)
+        return db.session.execute(query).all()
+
+    @classmethod
+    def export_batches(cls, start=None, end=None, user_id=None, batch_size=1000):
+        """Stream attendance joined with user details as batches of rows.
+
+        Rows are fetched with yield_per so memory stays constant however large
+        the table is.
+        """
+        query = cls.filtered(
+            db.select(cls.id, cls.timestamp, cls.user_id, User.name, User.email, User.custom_data)
+            .join(User, User.id == cls.user_id),
+            start, end, user_id
+        ).order_by(cls.id).execution_options(yield_per=batch_size)
+        return db.session.execute(query).partitions()
+
+
+class GalleryState(db.Model):
+    """Single row counting changes to users and face templates.
+
+    Saved gallery snapshots record the stamp they were built from and are
+    only reused while it is unchanged.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls, session=None):
+        """Count a change in the current transaction (needed for bulk statements the ORM does not see)"""
+        session = session or db.session
+        updated = session.execute(db.update(cls).where(cls.id == 1).values(version=cls.version + 1))
+        if not updated.rowcount:
+            session.execute(db.insert(cls).values(id=1, version=1))
+
+    @classmethod
+    def stamp(cls):
+        """Change counter plus row counts, cheap to read and different after any gallery change"""
+        version = db.session.execute(db.select(cls.version).where(cls.id == 1)).scalar() or 0
+        users, max_id = db.session.execute(db.select(db.func.count(User.id), db.func.max(User.id))).one()
+        templates = db.session.execute(db.select(db.func.count(FaceTemplate.id))).scalar()
+        return f'{version}:{users}:{max_id or 0}:{templates}'
+
+@event.listens_for(Session, 'after_flush')
+def _count_gallery_changes(session, flush_context):
+    """Bump the gallery version in the same transaction as any user or template change"""
+    changed = itertools.chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(obj, (User, FaceTemplate)) for obj in changed):
+        GalleryState.bump(session)
+
+def ensure_indexes():
+    """Create indexes added after the tables (create_all skips existing tables)"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
@@ -0,0 +1,230 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import gallery_store
+from face_utils import (ingest_image, load_models, recognize_tracked, recognize_faces_batch,
+                        DEFAULT_DETECTION, DEFAULT_INGEST)
+from gallery import FaceGallery, GallerySnapshot
+from metrics import metrics, profiler
+
+
+class PoolBusy(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+
+
+# Per-process state of a recognition worker
+_worker_gallery = None
+_worker_generation = 0
+_worker_settings = None
+_worker_ingest = DEFAULT_INGEST
+
+
+def _init_worker(snapshot, index, settings, ingest, instrumentation):
+    """Give a fresh worker process its own copy of the face gallery.
+
+    ``snapshot`` is a GallerySnapshot, or the (path, stamp) of one saved by
+    the web process, which is memory mapped instead of sent through the pipe.
+    """
+    global _worker_gallery, _worker_generation, _worker_settings, _worker_ingest
+    _worker_gallery = FaceGallery(index=index)
+    if not isinstance(snapshot, GallerySnapshot):
+        path, stamp = snapshot
+        saved = gallery_store.load(path, stamp)
+        if saved is None:
+            # Replaced or removed since the pool checked it; the pool restarts from a pickled snapshot
+            raise RuntimeError(f'Gallery snapshot {path} is missing or stale')
+        _worker_gallery.load_snapshot(saved, copy=False)
+    else:
+        _worker_gallery.load_snapshot(snapshot)
+    _worker_generation = 0
+    _worker_settings = settings
+    _worker_ingest = ingest
+    # Stage timings are sent back with each result instead of kept here
+    metrics_enabled, profile_rate, profile_dir, profile_max_files = instrumentation
+    metrics.configure(metrics_enabled, buffered=True)
+    profiler.configure(profile_rate, profile_dir, profile_max_files)
+    # Load the dlib models before the first task instead of during it
+    load_models()
+
+
+def _apply_changes(changes):
+    """Replay gallery changes the worker has not seen yet"""
+    global _worker_generation
+    for generation, operation, args in changes:
+        if generation <= _worker_generation:
+            continue
+        getattr(_worker_gallery, operation)(*args)
+        _worker_generation = generation
+
+
+def _warm_up():
+    return os.getpid(), _worker_generation
+
+
+def _recognize(request, changes, tolerance):
+    """Decode and recognize one image inside a worker process"""
+    image_data, roi, tracks, iou_threshold, max_hash_distance = request
+    _apply_changes(changes)
+    with profiler.sample('recognize'):
+        frame, origin = ingest_image(image_data, _worker_ingest, _worker_settings, roi)
+        faces = recognize_tracked(frame, _worker_gallery, tracks, tolerance, _worker_settings,
+                                  iou_threshold, max_hash_distance, origin)
+    return os.getpid(), _worker_generation, faces, metrics.drain()
+
+
+def _recognize_batch(images, changes, tolerance):
+    """Decode and recognize a batch of images inside a worker process"""
+    _apply_changes(changes)
+    with profiler.sample('recognize_batch'):
+        frames, origins, errors = decode_images(images, _worker_ingest, _worker_settings)
+        results = recognize_faces_batch(frames, _worker_gallery, tolerance, _worker_settings, origins)
+    return os.getpid(), _worker_generation, results, errors, metrics.drain()
+
+
+def decode_images(images, ingest=DEFAULT_INGEST, settings=DEFAULT_DETECTION):
+    """Decode a list of encoded images; rejected or undecodable ones become None with an error message"""
+    frames = []
+    origins = []
+    errors = []
+    for image_data in images:
+        try:
+            frame, origin = ingest_image(image_data, ingest, settings)
+            frames.append(frame)
+            origins.append(origin)
+            errors.append(None)
+        except Exception as e:
+            frames.append(None)
+            origins.append(None)
+            errors.append(str(e))
+    return frames, origins, errors
+
+
+class RecognitionPool:
+    """Process pool that runs recognition off the request threads.
+
+    At most ``workers + queue_size`` images are in flight; beyond that
+    ``recognize`` raises PoolBusy immediately instead of queueing. Gallery
+    changes are published as a generation-numbered log that is sent along
+    with each task, so every worker catches up before it matches a face.
+    """
+
+    def __init__(self, gallery, settings, workers, queue_size=0, tolerance=0.6, snapshot_file=None,
+                 ingest=DEFAULT_INGEST):
+        self.gallery = gallery
+        self.settings = settings
+        self.ingest = ingest
+        self.workers = workers
+        self.tolerance = tolerance
+        # (path, stamp, gallery version) of a snapshot saved on disk by the web process
+        self.snapshot_file = snapshot_file
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._start()
+        atexit.register(self.shutdown)
+
+    def _start(self):
+        """Start worker processes from a fresh snapshot of the gallery"""
+        with self._lock:
+            self._generation = 0
+            self._changes = []
+            self._worker_generations = {}
+            snapshot = self._saved_snapshot() or self.gallery.snapshot()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(snapshot, self.gallery.index, self.settings, self.ingest,
+                          (metrics.enabled, profiler.rate, profiler.directory, profiler.max_files))
+            )
+            # Spawn the workers (and load the dlib models) right away
+            for _ in range(self.workers):
+                self._executor.submit(_warm_up)
+
+    def _saved_snapshot(self):
+        """(path, stamp) for workers to map, while the gallery has not changed since it was
+        saved and the files on disk still carry its stamp (another process may share them)"""
+        if not self.snapshot_file:
+            return None
+        path, stamp, version = self.snapshot_file
+        if version != self.gallery.version or gallery_store.load(path, stamp) is None:
+            return None
+        return path, stamp
+
+    def publish(self, operation, *args):
+        """Queue a FaceGallery method call for every worker to replay"""
+        with self._lock:
+            self._generation += 1
+            self._changes.append((self._generation, operation, args))
+
+    def _task_done(self, future):
+        self._slots.release()
+        if future.cancelled() or future.exception():
+            return
+        pid, generation = future.result()[:2]
+        with self._lock:
+            self._worker_generations[pid] = generation
+            # Drop log entries once every worker has applied them
+            if len(self._worker_generations) == self.workers:
+                applied = min(self._worker_generations.values())
+                self._changes = [change for change in self._changes if change[0] > applied]
+
+    def recognize(self, image_data, tracks=(), iou_threshold=0.5, max_hash_distance=10, timeout=None, roi=None):
+        """Recognize faces in an encoded image, reusing tracks; returns a list of TrackedFace"""
+        request = (image_data, roi, list(tracks), iou_threshold, max_hash_distance)
+        pid, generation, faces, observations = self._run(_recognize, request, timeout=timeout)
+        metrics.absorb(observations)
+        return faces
+
+    def recognize_batch(self, images, timeout=None):
+        """Recognize a batch of encoded images on one worker; returns (results, errors)"""
+        pid, generation, results, errors, observations = self._run(_recognize_batch, images, timeout=timeout)
+        metrics.absorb(observations)
+        return results, errors
+
+    def _run(self, task, payload, timeout=None):
+        """Submit a task to the pool, failing fast with PoolBusy when it is full"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy('All recognition workers are busy')
+
+        executor = self._executor
+        try:
+            with self._lock:
+                changes = list(self._changes)
+            future = executor.submit(task, payload, changes, self.tolerance)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._restart(executor)
+            raise
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(self._task_done)
+        try:
+            return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise
+
+    def reload(self):
+        """Restart the workers after the whole gallery was rebuilt"""
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        self._start()
+
+    def _restart(self, broken):
+        """A worker died; restart the pool from the current gallery (once per breakage)"""
+        if self._executor is broken:
+            broken.shutdown(wait=False)
+            # Don't map the saved snapshot again in case it is what broke the workers
+            self.snapshot_file = None
+            self._start()
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None